@@ -1 +1 @@
-from modules import layers, models, data, losses, samplers
+from modules import layers, models, data, losses, samplers, cache, inference
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+import numpy as np
+import torch, glob, hashlib, socket, os
+
+class TextEmbeddingCache:
+    '''
+    Disk-backed, content-addressed cache of text embeddings (keyed by a hash of the caption and the text encoder version).
+    Embeddings are stored in fp16 memory-mapped shards with an append-only key file per shard, with an in-memory LRU in front.
+    Every process writes to its own shards (writer_id), shards of other writers are picked up when the cache is opened.
+    '''
+    def __init__(self, cache_dir, version, embedding_shape, shard_size=4096, lru_size=1024, writer_id=None):
+        '''
+        cache_dir: directory holding the shards
+        version: identifier of everything the embedding depends on besides the text (e.g. model name and max length)
+        embedding_shape: shape of one embedding, e.g. (max_length, hidden_size)
+        shard_size: number of embeddings per shard file
+        lru_size: number of embeddings kept in memory
+        writer_id: name of this process' shards, must be unique among the processes using the cache concurrently
+            (None = hostname and pid, so e.g. several runs on the same device never write to the same file)
+        '''
+        self.cache_dir = cache_dir
+        self.version = version
+        self.embedding_shape = tuple(embedding_shape)
+        self.shard_size = shard_size
+        self.lru_size = lru_size
+        self.writer_id = f'{socket.gethostname()}-{os.getpid()}' if writer_id is None else writer_id
+        self.lru = OrderedDict() # key -> fp16 cpu tensor
+        self.index = {} # key -> (shard name, row)
+        self.shards = {} # shard name -> memmap, opened lazily
+        os.makedirs(cache_dir, exist_ok=True)
+
+        own_shards = []
+        for keys_fname in sorted(glob.glob(f'{cache_dir}/*.keys')):
+            name = os.path.basename(keys_fname)[:-len('.keys')]
+            keys = open(keys_fname).read().split()
+            for row, key in enumerate(keys):
+                self.index[key] = (name, row)
+            if name.rsplit('_', 1)[0] == str(self.writer_id):
+                own_shards.append((name, len(keys)))
+
+        # continue appending to this writer's last shard if it has room left
+        if own_shards != [] and own_shards[-1][1] < shard_size:
+            self.write_shard, self.write_row = own_shards[-1]
+        else:
+            self.write_shard, self.write_row = None, 0
+        self.n_own_shards = len(own_shards)
+
+    def key(self, text):
+        return hashlib.sha1(f'{self.version}\0{text}'.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _get_shard(self, name, writable=False):
+        if name not in self.shards or (writable and self.shards[name].mode == 'r'):
+            self.shards[name] = np.load(f'{self.cache_dir}/{name}.npy', mmap_mode='r+' if writable else 'r')
+        return self.shards[name]
+
+    def _lru_put(self, key, embedding):
+        self.lru[key] = embedding
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get(self, keys):
+        '''
+        Returns a dict key -> fp16 cpu embedding of the keys that are in the cache.
+        '''
+        found = {}
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+            elif key in self.index:
+                name, row = self.index[key]
+                embedding = torch.from_numpy(np.array(self._get_shard(name)[row]))
+                self._lru_put(key, embedding)
+                found[key] = embedding
+        return found
+
+    def put(self, keys, embeddings):
+        '''
+        keys: list of N keys (from self.key)
+        embeddings: (N, *embedding_shape) tensor
+        '''
+        embeddings = embeddings.detach().to('cpu', torch.float16)
+        new_keys = {} # shard name -> [(key, row)]
+        for key, embedding in zip(keys, embeddings):
+            if key in self.index:
+                continue
+            if self.write_shard is None or self.write_row == self.shard_size:
+                self.write_shard = f'{self.writer_id}_{self.n_own_shards:0>5}'
+                self.write_row = 0
+                self.n_own_shards += 1
+                self.shards[self.write_shard] = np.lib.format.open_memmap(f'{self.cache_dir}/{self.write_shard}.npy', mode='w+',
+                        dtype=np.float16, shape=(self.shard_size, *self.embedding_shape))
+            self._get_shard(self.write_shard, writable=True)[self.write_row] = embedding.numpy()
+            new_keys.setdefault(self.write_shard, []).append((key, self.write_row))
+            self.index[key] = (self.write_shard, self.write_row)
+            self.write_row += 1
+            self._lru_put(key, embedding)
+
+        for name, shard_keys in new_keys.items():
+            self.shards[name].flush()
+            with open(f'{self.cache_dir}/{name}.keys', 'a') as f: # keys are only written once their rows are on disk
+                f.write(''.join(f'{key}\n' for key, _row in shard_keys))
@@ -1,27 +1,525 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from concurrent.futures import ThreadPoolExecutor
+from transformers import CLIPTokenizerFast
 from PIL import Image
+from tqdm import tqdm
+import torch.distributed as dist
+import multiprocessing as mp
 import torch.nn.functional as F
 import torch.nn as nn
 import numpy as np
-import torch, glob, os
+import torch, glob, json, io, os
 
 class ImgTextDataset(Dataset):
-    def __init__(self, img_folder_path, caption_file, crop_size=128):
+    def __init__(self, img_folder_path, caption_file, crop_size=128, manifest_dir=None, buckets=None):
+        '''
+        manifest_dir: manifest written by scripts/build_manifest.py, used instead of globbing img_folder_path and reading caption_file
+        buckets: list of (H, W) resolutions (e.g. from make_buckets), every image is resized and cropped to the bucket closest
+            to its aspect ratio instead of a crop_size square (needs manifest_dir for the image sizes, batch with AspectRatioBucketSampler)
+        '''
         super().__init__()
-        # note: img_fnames must correspond to img_captions by index, i.e. the text of img_captions[0] must describe the image with filename=img_fnames[0]
-        self.img_fnames = sorted(glob.glob(f'{img_folder_path}/*jpg') + glob.glob(f'{img_folder_path}/*png'))
-        self.img_captions = open(caption_file).read().strip().split('\n')
+        self.manifest = None
+        if manifest_dir is not None:
+            self.manifest = Manifest(manifest_dir)
+            self.img_fnames, self.img_captions = self.manifest.fnames, self.manifest.captions
+        else:
+            # note: img_fnames must correspond to img_captions by index, i.e. the text of img_captions[0] must describe the image with filename=img_fnames[0]
+            self.img_fnames = sorted(glob.glob(f'{img_folder_path}/*jpg') + glob.glob(f'{img_folder_path}/*png'))
+            self.img_captions = open(caption_file).read().strip().split('\n')
         self.crop_size = crop_size
         assert len(self.img_fnames) == len(self.img_captions)
 
+        self.buckets = buckets
+        self.bucket_idxs = None
+        if buckets is not None:
+            assert self.manifest is not None, 'aspect ratio buckets need the image sizes of a manifest'
+            self.bucket_idxs = assign_buckets(self.manifest.widths, self.manifest.heights, buckets)
+
     def __len__(self):
         return len(self.img_fnames)
 
     def __getitem__(self, idx):
         img_fname = self.img_fnames[idx]
         img_caption = self.img_captions[idx]
-        img = np.array(Image.open(img_fname))
-        H, W, _C = img.shape
-        img = img[(H-self.crop_size)//2:(H+self.crop_size)//2,
-                (W-self.crop_size)//2:(W+self.crop_size)//2] # center crop
+        crop_size = self.crop_size if self.buckets is None else self.buckets[self.bucket_idxs[idx]]
+        img = load_image(img_fname, crop_size)
+        return img, img_caption
+
+def load_image(src, crop_size):
+    '''
+    Decodes an image (filename or file object) into a contiguous (3, H, W) uint8 tensor, crop_size being an int (square)
+    or (H, W): the image is resized so it just covers the crop, then center cropped. Only the pixels needed are decoded:
+    JPEGs are decoded at the smallest DCT scale still covering the crop (draft mode), other formats are box-reduced by an
+    integer factor first, and the resize only reads the center region. Grayscale/palette/CMYK images are converted to RGB,
+    transparency is composited onto white.
+    '''
+    crop_h, crop_w = (crop_size, crop_size) if isinstance(crop_size, int) else crop_size
+    img = Image.open(src)
+    img.draft('RGB', (crop_w, crop_h)) # no-op for non-JPEGs, otherwise the sides stay >= the crop
+    is_jpeg = img.format == 'JPEG'
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        img = Image.alpha_composite(background, img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    W, H = img.size
+    reduce_factor = min(W // crop_w, H // crop_h)
+    if not is_jpeg and reduce_factor >= 2:
+        img = img.reduce(reduce_factor)
+        W, H = img.size
+
+    # largest centered region with the crop's aspect ratio, in source pixels
+    box_w, box_h = (H * crop_w / crop_h, H) if W * crop_h > H * crop_w else (W, W * crop_h / crop_w)
+    box = ((W-box_w)/2, (H-box_h)/2, (W+box_w)/2, (H+box_h)/2)
+    if (box_w, box_h) != (crop_w, crop_h):
+        img = img.resize((crop_w, crop_h), Image.BICUBIC, box=box)
+    else:
+        img = img.crop(tuple(round(b) for b in box))
+    return torch.from_numpy(np.asarray(img).transpose(2, 0, 1).copy()) # H W C -> C H W
+
+def make_buckets(base_size=256, multiple=64, max_aspect_ratio=2.0):
+    '''
+    Returns (H, W) resolutions with about base_size**2 pixels each, sides being multiples of multiple (which should be
+    divisible by the total VAE + UNet downsampling factor) and aspect ratios up to max_aspect_ratio.
+    '''
+    buckets = set()
+    for W in range(multiple, int(base_size * max_aspect_ratio) + 1, multiple):
+        H = max(multiple, round(base_size**2 / W / multiple) * multiple)
+        if max(H / W, W / H) <= max_aspect_ratio:
+            buckets.update([(H, W), (W, H)])
+    return sorted(buckets, key=lambda size: size[1] / size[0])
+
+def assign_buckets(widths, heights, buckets):
+    '''
+    Returns the index of the bucket closest in (log) aspect ratio for every image.
+    '''
+    bucket_ratios = np.log([W / H for H, W in buckets])
+    ratios = np.log(np.asarray(widths, dtype=np.float64) / np.asarray(heights, dtype=np.float64))
+    return np.abs(ratios[:, None] - bucket_ratios[None, :]).argmin(axis=1).astype(np.int32)
+
+class AspectRatioBucketSampler(Sampler):
+    '''
+    Batch sampler yielding batches whose images all come from the same aspect ratio bucket (so they share one shape).
+    Each epoch the images are shuffled within their buckets, cut into full batches, and the shuffled batches are split
+    over the distributed ranks so that every rank gets the same number of batches.
+    '''
+    def __init__(self, bucket_idxs, batch_size, num_replicas=None, rank=None, seed=0):
+        '''
+        bucket_idxs: bucket index of every dataset image (ImgTextDataset.bucket_idxs)
+        batch_size: per-rank batch size
+        num_replicas, rank: distributed world size and rank (read from torch.distributed if None)
+        '''
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.bucket_idxs = np.asarray(bucket_idxs)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        bucket_sizes = np.bincount(self.bucket_idxs)
+        self.n_batches = int((bucket_sizes // batch_size).sum()) // num_replicas # per rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        batches = []
+        for bucket_idx in range(self.bucket_idxs.max() + 1):
+            idxs = rng.permutation(np.flatnonzero(self.bucket_idxs == bucket_idx))
+            n_full = len(idxs) // self.batch_size * self.batch_size # drop the incomplete batch of every bucket
+            batches += np.split(idxs[:n_full], n_full // self.batch_size) if n_full > 0 else []
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        for batch in batches[self.rank:self.n_batches * self.num_replicas:self.num_replicas]:
+            yield batch.tolist()
+
+class StringColumn:
+    '''
+    Read-only sequence of strings stored as one utf-8 byte array plus an offsets array (both memory-mapped).
+    '''
+    def __init__(self, data, offsets, prefix=''):
+        self.data = data
+        self.offsets = offsets
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx:idx+2].tolist()
+        return self.prefix + self.data[start:end].tobytes().decode('utf-8')
+
+    @staticmethod
+    def pack(strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.cumsum([0] + [len(string) for string in encoded], dtype=np.int64)
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+class Manifest:
+    '''
+    Columnar dataset manifest (a directory of .npy columns + meta.json) written by scripts/build_manifest.py.
+    Columns are memory-mapped: fnames/captions are StringColumns, widths/heights/nbytes are arrays and
+    modes holds indices into meta['modes']. Only images that passed validation are in the manifest.
+    '''
+    COLUMNS = ('fname_data', 'fname_offsets', 'caption_data', 'caption_offsets', 'widths', 'heights', 'modes', 'nbytes')
+
+    def __init__(self, manifest_dir):
+        self.manifest_dir = manifest_dir
+        with open(f'{manifest_dir}/meta.json') as f:
+            self.meta = json.load(f)
+        columns = {name: np.load(f'{manifest_dir}/{name}.npy', mmap_mode='r') for name in self.COLUMNS}
+        self.fnames = StringColumn(columns['fname_data'], columns['fname_offsets'], prefix=self.meta['img_folder_path'] + '/')
+        self.captions = StringColumn(columns['caption_data'], columns['caption_offsets'])
+        self.widths, self.heights = columns['widths'], columns['heights']
+        self.modes, self.nbytes = columns['modes'], columns['nbytes']
+
+    def __len__(self):
+        return len(self.fnames)
+
+    @staticmethod
+    def write(manifest_dir, img_folder_path, fnames, captions, widths, heights, modes, nbytes):
+        '''
+        fnames: image filenames relative to img_folder_path
+        modes: PIL mode string per image
+        '''
+        os.makedirs(manifest_dir, exist_ok=True)
+        mode_names = sorted(set(modes))
+        mode_idxs = {mode: idx for idx, mode in enumerate(mode_names)}
+        columns = {}
+        columns['fname_data'], columns['fname_offsets'] = StringColumn.pack(fnames)
+        columns['caption_data'], columns['caption_offsets'] = StringColumn.pack(captions)
+        columns['widths'] = np.asarray(widths, dtype=np.int32)
+        columns['heights'] = np.asarray(heights, dtype=np.int32)
+        columns['modes'] = np.asarray([mode_idxs[mode] for mode in modes], dtype=np.uint8)
+        columns['nbytes'] = np.asarray(nbytes, dtype=np.int64)
+        for name in Manifest.COLUMNS:
+            np.save(f'{manifest_dir}/{name}.npy', columns[name])
+        with open(f'{manifest_dir}/meta.json', 'w') as f:
+            json.dump({'img_folder_path': img_folder_path, 'modes': mode_names, 'n_images': len(fnames)}, f, indent=1)
+
+PACKED_INDEX_DTYPE = np.dtype([('shard', '<u4'), ('offset', '<u8'), ('img_len', '<u4'), ('caption_len', '<u4')])
+
+def write_packed_shards(img_fnames, captions, packed_dir, shard_bytes=2**30, verbose=True):
+    '''
+    Packs encoded image files and their captions into large shard files (shard_XXXXX.bin, each record is the raw image
+    bytes followed by the utf-8 caption) plus an index.npy of (shard, offset, img_len, caption_len) rows read by PackedImgTextDataset.
+    shard_bytes: a new shard is started once the current one reaches this size
+    '''
+    assert len(img_fnames) == len(captions)
+    os.makedirs(packed_dir, exist_ok=True)
+    index = np.lib.format.open_memmap(f'{packed_dir}/index.npy', mode='w+', dtype=PACKED_INDEX_DTYPE, shape=(len(img_fnames),))
+    shard_idx, offset, shard_file = -1, shard_bytes, None
+    for idx, (img_fname, caption) in enumerate(tqdm(zip(img_fnames, captions), total=len(captions), disable=not verbose)):
+        if offset >= shard_bytes:
+            if shard_file is not None:
+                shard_file.close()
+            shard_idx, offset = shard_idx + 1, 0
+            shard_file = open(f'{packed_dir}/shard_{shard_idx:0>5}.bin', 'wb')
+        img_bytes = open(img_fname, 'rb').read()
+        caption_bytes = caption.encode('utf-8')
+        shard_file.write(img_bytes + caption_bytes)
+        index[idx] = (shard_idx, offset, len(img_bytes), len(caption_bytes))
+        offset += len(img_bytes) + len(caption_bytes)
+    if shard_file is not None:
+        shard_file.close()
+    index.flush()
+
+class PackedImgTextDataset(Dataset):
+    '''
+    Same samples as ImgTextDataset, read from shards written by write_packed_shards (scripts/pack_dataset.py).
+    The index is memory-mapped and each record is read with a single positional read, so startup is instant and
+    per-worker memory doesn't grow with the dataset size.
+    '''
+    def __init__(self, packed_dir, crop_size=128):
+        super().__init__()
+        self.packed_dir = packed_dir
+        self.crop_size = crop_size
+        self.index = np.load(f'{packed_dir}/index.npy', mmap_mode='r')
+        self.shard_fds = {} # opened lazily per process
+
+    def __getstate__(self): # file descriptors aren't valid in other (spawned) dataloader workers
+        state = self.__dict__.copy()
+        state['shard_fds'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_record(self, idx):
+        shard_idx, offset, img_len, caption_len = self.index[idx].tolist()
+        if shard_idx not in self.shard_fds:
+            self.shard_fds[shard_idx] = os.open(f'{self.packed_dir}/shard_{shard_idx:0>5}.bin', os.O_RDONLY)
+        record = os.pread(self.shard_fds[shard_idx], img_len + caption_len, offset)
+        return record[:img_len], record[img_len:].decode('utf-8')
+
+    def __getitem__(self, idx):
+        img_bytes, img_caption = self.read_record(idx)
+        img = load_image(io.BytesIO(img_bytes), self.crop_size)
         return img, img_caption
+
+class LatentStoreWriter:
+    '''
+    Writes VAE latent parameters (mean and logvar, concatenated on the channel axis like the VAEEncoder output) and captions
+    into fp16 memory-mapped shards plus an index.json, read back by LatentTextDataset.
+    '''
+    def __init__(self, latent_dir, n_samples, latent_shape, shard_size=65536):
+        '''
+        latent_dir: output directory of the latent store
+        n_samples: total number of samples that will be added
+        latent_shape: (2*nz, H, W) shape of one sample's latent parameters
+        shard_size: number of samples per shard file
+        '''
+        self.latent_dir = latent_dir
+        self.n_samples = n_samples
+        self.latent_shape = tuple(latent_shape)
+        self.shard_size = shard_size
+        self.channel_scale = None # per-channel RMS of the first batch, stored values are divided by it to use the fp16 range evenly
+        self.shards = []
+        self.n_written = 0
+        self.shard = self.shard_captions = None
+        self.mean_sums = np.zeros(2) # sum and sum of squares of the means, for the global latent std
+        os.makedirs(latent_dir, exist_ok=True)
+
+    def _open_shard(self):
+        shard_idx = len(self.shards)
+        count = min(self.shard_size, self.n_samples - self.n_written)
+        name = f'shard_{shard_idx:0>5}'
+        self.shard = np.lib.format.open_memmap(f'{self.latent_dir}/{name}.npy', mode='w+', dtype=np.float16, shape=(count, *self.latent_shape))
+        self.shard_captions = []
+        self.shard_pos = 0
+        self.shards.append({'name': name, 'count': count})
+
+    def _close_shard(self):
+        self.shard.flush()
+        with open(f"{self.latent_dir}/{self.shards[-1]['name']}.txt", 'w') as f:
+            f.write('\n'.join(self.shard_captions))
+        self.shard = self.shard_captions = None
+
+    def add(self, z_params, captions):
+        '''
+        z_params: (B, 2*nz, H, W) float array of VAE encoder outputs
+        captions: list of B captions
+        '''
+        z_params = np.asarray(z_params, dtype=np.float32)
+        if self.channel_scale is None:
+            self.channel_scale = np.maximum(np.sqrt((z_params**2).mean(axis=(0, 2, 3))), 1e-3)
+        nz = self.latent_shape[0] // 2
+        mean = z_params[:, :nz].astype(np.float64)
+        self.mean_sums += (mean.sum(), (mean**2).sum())
+
+        scaled = z_params / self.channel_scale[None, :, None, None]
+        start = 0
+        while start < len(scaled):
+            if self.shard is None:
+                self._open_shard()
+            n = min(len(scaled) - start, len(self.shard) - self.shard_pos)
+            self.shard[self.shard_pos:self.shard_pos+n] = scaled[start:start+n]
+            self.shard_captions += captions[start:start+n]
+            self.shard_pos += n
+            self.n_written += n
+            start += n
+            if self.shard_pos == len(self.shard):
+                self._close_shard()
+
+    def close(self):
+        if self.shard is not None:
+            self._close_shard()
+        assert self.n_written == self.n_samples, f'wrote {self.n_written} samples, expected {self.n_samples}'
+
+        n_means = self.n_written * np.prod(self.latent_shape) / 2
+        z_mean = self.mean_sums[0] / n_means
+        z_std = (self.mean_sums[1] / n_means - z_mean**2) ** 0.5
+        index = {
+            'latent_shape': list(self.latent_shape),
+            'dtype': 'float16',
+            'channel_scale': self.channel_scale.tolist(),
+            'z_std': float(z_std),
+            'shards': self.shards,
+        }
+        with open(f'{self.latent_dir}/index.json', 'w') as f:
+            json.dump(index, f, indent=1)
+
+class LatentTextDataset(Dataset):
+    '''
+    Reads a latent store written by scripts/encode_latents.py. Returns the same (2*nz, H, W) latent parameters as
+    VAEEncoder would for the image, so DDPM training can skip image decoding and the VAE encoder entirely.
+    '''
+    def __init__(self, latent_dir):
+        super().__init__()
+        self.latent_dir = latent_dir
+        with open(f'{latent_dir}/index.json') as f:
+            index = json.load(f)
+        self.latent_shape = tuple(index['latent_shape'])
+        self.nz = self.latent_shape[0] // 2
+        self.z_std = index['z_std']
+        self.channel_scale = torch.tensor(index['channel_scale'], dtype=torch.float32)[:, None, None]
+        self.shard_names = [shard['name'] for shard in index['shards']]
+        self.shard_starts = np.cumsum([0] + [shard['count'] for shard in index['shards']])
+        self.shards = {} # opened lazily so every dataloader worker memory-maps its own files
+        self.shard_captions = {}
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def _get_shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            name = self.shard_names[shard_idx]
+            self.shards[shard_idx] = np.load(f'{self.latent_dir}/{name}.npy', mmap_mode='r')
+            self.shard_captions[shard_idx] = open(f'{self.latent_dir}/{name}.txt').read().split('\n')
+        return self.shards[shard_idx], self.shard_captions[shard_idx]
+
+    def __getitem__(self, idx):
+        shard_idx = int(np.searchsorted(self.shard_starts, idx, side='right')) - 1
+        shard, captions = self._get_shard(shard_idx)
+        row = idx - self.shard_starts[shard_idx]
+        z_params = torch.from_numpy(np.array(shard[row], dtype=np.float32)) * self.channel_scale
+        return z_params, captions[row]
+
+class StreamingImgTextDataset(PackedImgTextDataset, IterableDataset):
+    '''
+    Streams the shards written by write_packed_shards sequentially instead of reading random records.
+    Every epoch the shards are concatenated in a random order and that record sequence is split into equal contiguous slices
+    per rank (so all DDP ranks run the same number of steps) and per dataloader worker. Records are read in chunks of bounded
+    size, the next chunk is read in the background while the current one is decoded, and samples are shuffled through a bounded buffer.
+    Random access (dataset[idx]) still works through the index, e.g. for picking preview captions.
+    '''
+    def __init__(self, packed_dir, crop_size=128, shuffle_buffer_size=1024, seed=0, chunk_bytes=64 * 2**20):
+        '''
+        shuffle_buffer_size: number of decoded samples held for shuffling per worker (1 = no shuffling)
+        seed: base seed of the per-epoch shard order and shuffle buffer
+        chunk_bytes: max bytes per read, each worker holds at most two chunks (the current and the prefetched one)
+        '''
+        super().__init__(packed_dir, crop_size)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.chunk_bytes = chunk_bytes
+        self.epoch = mp.Value('i', 0) # shared with (persistent) dataloader workers so set_epoch reaches them
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized(): # process groups aren't set up in the workers, so read it here
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        shards = np.asarray(self.index['shard'])
+        self.shard_starts = np.searchsorted(shards, np.arange(shards[-1] + 2)) # records of shard i are rows shard_starts[i]:shard_starts[i+1]
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def samples_per_rank(self):
+        return -(-len(self.index) // self.world_size) # the last slices wrap around to the start, like DistributedSampler's padding
+
+    def __len__(self): # what this rank streams per epoch (dataset[idx] still accepts any of the len(self.index) records)
+        return self.samples_per_rank()
+
+    def get_worker_ranges(self):
+        '''
+        Returns the (start, end) index row ranges this (rank, worker) streams this epoch, each within a single shard.
+        '''
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = np.random.default_rng((self.seed, self.epoch.value))
+        shard_order = rng.permutation(len(self.shard_starts) - 1)
+        seq_starts = np.concatenate([[0], np.cumsum(np.diff(self.shard_starts)[shard_order])]) # position of each shard in the epoch's record sequence
+        per_rank = self.samples_per_rank()
+        pos = self.rank * per_rank + per_rank * worker_id // num_workers
+        end = self.rank * per_rank + per_rank * (worker_id + 1) // num_workers
+        ranges = []
+        while pos < end:
+            wrapped = pos % len(self.index)
+            i = np.searchsorted(seq_starts, wrapped, side='right') - 1
+            n = min(seq_starts[i+1] - wrapped, end - pos)
+            first = self.shard_starts[shard_order[i]] + wrapped - seq_starts[i]
+            ranges.append((int(first), int(first + n)))
+            pos += n
+        return ranges
+
+    def get_chunks(self, ranges):
+        # splits the row ranges into runs of consecutive records of at most chunk_bytes (at least one record each)
+        for start, end in ranges:
+            records = np.asarray(self.index[start:end])
+            record_ends = records['offset'] + records['img_len'] + records['caption_len']
+            i = 0
+            while i < len(records):
+                j = max(i + 1, int(np.searchsorted(record_ends, records['offset'][i] + self.chunk_bytes, side='right')))
+                yield records[i:j]
+                i = j
+
+    def read_chunk(self, records):
+        shard_idx, start = int(records['shard'][0]), int(records['offset'][0])
+        if shard_idx not in self.shard_fds:
+            self.shard_fds[shard_idx] = os.open(f'{self.packed_dir}/shard_{shard_idx:0>5}.bin', os.O_RDONLY)
+        last = records[-1]
+        return records, os.pread(self.shard_fds[shard_idx], int(last['offset'] + last['img_len'] + last['caption_len']) - start, start)
+
+    def iter_records(self, ranges):
+        chunks = self.get_chunks(ranges)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            first = next(chunks, None)
+            next_chunk = None if first is None else pool.submit(self.read_chunk, first)
+            while next_chunk is not None:
+                records, chunk = next_chunk.result()
+                following = next(chunks, None)
+                next_chunk = None if following is None else pool.submit(self.read_chunk, following) # prefetch while this chunk is decoded
+                base = int(records['offset'][0])
+                for _shard, offset, img_len, caption_len in records.tolist():
+                    offset -= base
+                    yield chunk[offset:offset+img_len], chunk[offset+img_len:offset+img_len+caption_len].decode('utf-8')
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = np.random.default_rng((self.seed, self.epoch.value, self.rank, worker_id))
+        buffer = []
+        for img_bytes, img_caption in self.iter_records(self.get_worker_ranges()):
+            sample = (load_image(io.BytesIO(img_bytes), self.crop_size), img_caption)
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.integers(len(buffer))
+            buffer[idx], sample = sample, buffer[idx]
+            yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+def set_epoch(dataloader, epoch_idx):
+    '''
+    Reshuffles a dataloader for a new epoch, whether its order comes from a (distributed) sampler or a streaming dataset.
+    '''
+    for obj in (dataloader.dataset, dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(obj, 'set_epoch'):
+            obj.set_epoch(epoch_idx)
+
+def tokenize(tokenizer, text, max_length):
+    batch_encoding = tokenizer(text, truncation=True, max_length=max_length, return_length=True,
+                                return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
+    return batch_encoding["input_ids"]
+
+class TokenizingCollate:
+    '''
+    Dataloader collate_fn that tokenizes the captions in the workers (one fast tokenizer per worker), so batches are
+    (uint8 images/latents, (B, max_length) input_ids) ready for FrozenCLIPEmbedder.encode_tokens.
+    '''
+    def __init__(self, version='openai/clip-vit-large-patch14', max_length=64):
+        '''
+        version, max_length: must match the FrozenCLIPEmbedder the ids are fed to
+        '''
+        self.version = version
+        self.max_length = max_length
+        self.tokenizer = None # built lazily inside each worker
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tokenizer'] = None
+        return state
+
+    def __call__(self, batch):
+        if self.tokenizer is None:
+            self.tokenizer = CLIPTokenizerFast.from_pretrained(self.version)
+        imgs, captions = zip(*batch)
+        return torch.stack(imgs), tokenize(self.tokenizer, list(captions), self.max_length)
@@ -0,0 +1,114 @@
+from modules.samplers import DDIMSampler, GuidanceSchedule, progress
+import torch._inductor.config
+import torch, os
+
+def enable_compile_cache(cache_dir):
+    '''
+    Points torch.compile's on-disk caches (inductor kernels, FX graphs, autotuning results) to cache_dir and loads the
+    portable cache artifacts saved by save_compile_cache, if any. Must be called before the first compilation.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(f'{cache_dir}/inductor')
+    torch._inductor.config.fx_graph_cache = True
+    artifacts_fname = f'{cache_dir}/artifacts.bin'
+    if os.path.exists(artifacts_fname):
+        with open(artifacts_fname, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+def save_compile_cache(cache_dir):
+    '''
+    Saves the artifacts of everything compiled so far in this process to cache_dir/artifacts.bin
+    (the inductor cache directory alone already works across restarts on the same machine, the artifacts also survive a copy to other workers).
+    '''
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return
+    artifacts_fname = f'{cache_dir}/artifacts.bin'
+    with open(f'{artifacts_fname}.tmp', 'wb') as f: # written next to the destination and renamed, so a crash never leaves a partial file
+        f.write(artifacts[0])
+    os.replace(f'{artifacts_fname}.tmp', artifacts_fname)
+
+class CompiledDDIMPipeline:
+    '''
+    Compiled inference mode: one UNet + DDIMSampler step (CFG included) and the VAEDecoder are each compiled as a single graph,
+    warmed up on an explicit list of shapes and persisted in a compile cache so restarted workers skip most of the compilation.
+    Shapes outside the warm-up list still work but compile on first use. Context KV caching (Sampler.cache_context) is not used,
+    the compiled step recomputes the context projections.
+    '''
+    def __init__(self, sampler, vae_decoder=None, cache_dir=None, mode=None):
+        '''
+        sampler: DDIMSampler whose denoiser is the UNet
+        vae_decoder: e.g. VAE.decoder, None to only compile the sampling step
+        cache_dir: directory of the persisted compile cache, None to only use the in-memory cache
+        mode: torch.compile mode (e.g. 'max-autotune', which benefits the most from the persisted autotuning results)
+        '''
+        assert isinstance(sampler, DDIMSampler)
+        if sampler.deep_cache is not None:
+            raise Exception('CompiledDDIMPipeline does not support deep_cache_interval, the cache decisions are python-side state.')
+        self.sampler = sampler
+        self.vae_decoder = vae_decoder
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+        # the step index is a device tensor (not an int) so all steps share one graph instead of compiling tau_dim of them
+        self.step_idxs = torch.arange(sampler.tau_dim + 1, device=sampler.timesteps.device)
+        self.compiled_step = torch.compile(self.step, mode=mode, dynamic=False)
+        self.compiled_decoder = None if vae_decoder is None else torch.compile(vae_decoder, mode=mode, dynamic=False)
+
+    def step(self, x, t, timesteps, context, uncond_context, cfg_weight):
+        cfg_batches = None
+        if self.sampler.batch_cfg and cfg_weight not in (0, None):
+            # built inside the graph: tensors nested in a list argument would invalidate the compiled graph every call
+            cfg_batches = self.sampler.get_cfg_batches(context, uncond_context, x.shape[0])
+        noise_pred = self.sampler.predict_noise(x, timesteps, context, uncond_context, cfg_weight, cfg_batches)
+        return self.sampler.denoise_step(x, t, noise_pred)
+
+    def get_samples(self, initial_x=None, x_shape=None, context=None, verbose=True, cfg_weight=3, device=None, uncond_context=None, max_steps=None):
+        '''
+        Same arguments and result as Sampler.get_samples. cfg_weight is a compile-time constant, every new value
+        (including every weight a GuidanceSchedule returns) compiles a new graph.
+        max_steps: stop after this many steps (used by warmup)
+        '''
+        sampler = self.sampler
+        if initial_x is None and x_shape is None:
+            raise Exception('Either initial_x or x_shape must be defined.')
+
+        x = torch.randn(x_shape, device=device) if initial_x is None else initial_x
+        if sampler.batch_cfg and cfg_weight not in (0, None) and (context is None or uncond_context is None):
+            raise Exception('batch_cfg requires both context and uncond_context to be defined.')
+
+        sampler.to(x.device)
+        step_idxs = self.step_idxs.to(x.device)
+        timesteps = sampler.timesteps[:, None].expand(-1, x.shape[0])
+        for t in progress(range(sampler.tau_dim, 0, -1)[:max_steps], verbose):
+            weight = cfg_weight(sampler.tau[t-1]) if isinstance(cfg_weight, GuidanceSchedule) else cfg_weight
+            x = self.compiled_step(x, step_idxs[t], timesteps[t-1], context, uncond_context, weight)
+        return x
+
+    def decode(self, z):
+        return self.compiled_decoder(z)
+
+    def warmup(self, shapes, context_len=64, cfg_weight=3, uncond_context=None, device=None, context_batch_size=None):
+        '''
+        Compiles the step (and decoder) for every shape, then saves the compile cache.
+        The arguments must match the later get_samples calls, any difference (e.g. uncond_context None or not) is another graph.
+        shapes: list of (batch_size, latent_channels, latent_height, latent_width)
+        context_len: sequence length of the text context (FrozenCLIPEmbedder.max_length)
+        cfg_weight: guidance weight or GuidanceSchedule the pipeline will be called with (None or 0 for unguided sampling)
+        uncond_context: unconditional context the pipeline will be called with (e.g. FrozenCLIPEmbedder.empty_embedding())
+        context_batch_size: batch size of the context get_samples will be called with, None = shape[0] (one prompt per sample),
+            1 for a single prompt broadcast over the batch
+        '''
+        device = self.sampler.timesteps.device if device is None else device
+        context_dim = self.sampler.denoiser.context_dim
+        self.sampler.to(device)
+        for shape in shapes:
+            x = torch.randn(shape, device=device)
+            context = torch.randn((shape[0] if context_batch_size is None else context_batch_size, context_len, context_dim), device=device)
+            # one step compiles the same graph as a full sampling run, unless a GuidanceSchedule switches weights between steps
+            max_steps = None if isinstance(cfg_weight, GuidanceSchedule) else 1
+            self.get_samples(initial_x=x, context=context, verbose=False, cfg_weight=cfg_weight, uncond_context=uncond_context, max_steps=max_steps)
+            if self.compiled_decoder is not None:
+                self.compiled_decoder(x)
+        if self.cache_dir is not None:
+            save_compile_cache(self.cache_dir)
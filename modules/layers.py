@@ -37,11 +37,14 @@ class ResBlock(nn.Module):
             self.temb_proj = nn.Linear(temb_c, nc)
         self.skip = nn.Conv2d(in_c, nc, 1, bias=False) if in_c != nc else None
         #self.skip = nn.Conv2d(in_c, nc, 1) if in_c != nc else None
+        self.temb_table = None # (n_steps, nc) projected time embeddings of the scheduled timesteps, see UNet.prepare_timestep_cache
     
-    def forward(self, x, temb=None): # temb = t (time) embedding
+    def forward(self, x, temb=None, step_idx=None): # temb = t (time) embedding, step_idx = row of temb_table used instead of temb
         skip = x if self.skip is None else self.skip(x)
         x = self.conv1(self.act1(self.norm1(x)))
-        if temb is not None:
+        if step_idx is not None:
+            x = x + self.temb_table[step_idx][None, :, None, None] # every sample of the batch is at the same timestep
+        elif temb is not None:
             x = x + self.temb_proj(F.silu(temb))[:, :, None, None]
         x = self.conv2(self.act2(self.norm2(x)))
 
@@ -52,10 +55,82 @@ class StableNorm(nn.Module): # runs GroupNorm in FP32 because of bfloat16 stabil
         super().__init__()
         #self.norm = nn.GroupNorm(num_groups, num_channels).double()
         self.norm = nn.GroupNorm(num_groups, num_channels) # if running on non-tpu
+        self.stats = None # (mean, var) of shape (B, num_groups) used instead of the input's own statistics (tiled VAE inference)
     
     def forward(self, x):
         #return self.norm(x.double()).float()
-        return self.norm(x)
+        if self.stats is None:
+            return self.norm(x)
+
+        B, C = x.shape[:2]
+        x_groups = x.float().reshape(B, self.norm.num_groups, -1)
+        mean, var = self.stats
+        x_groups = (x_groups - mean[..., None]) * torch.rsqrt(var[..., None] + self.norm.eps)
+        x_norm = x_groups.reshape(B, C, -1) * self.norm.weight[:, None] + self.norm.bias[:, None]
+        return x_norm.reshape(x.shape).to(x.dtype)
+
+class GroupNormSiLU(torch.autograd.Function):
+    '''
+    silu(group_norm(x)) with (at least) fp32 statistics and arithmetic. Only x and the per-group statistics are saved for backward,
+    which recomputes the normalized activations instead of keeping the norm's output (the activation's input) alive.
+    '''
+    @staticmethod
+    def forward(ctx, x, num_groups, weight, bias, eps):
+        B, C = x.shape[:2]
+        x32, weight32, bias32 = (t.to(torch.promote_types(t.dtype, torch.float32)) for t in (x, weight, bias))
+        out, mean, rstd = torch.native_group_norm(x32, weight32, bias32, B, C, x[0, 0].numel(), num_groups, eps)
+        ctx.save_for_backward(x, weight, bias, mean, rstd)
+        ctx.num_groups, ctx.eps = num_groups, eps
+        return F.silu(out, inplace=True).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, bias, mean, rstd = ctx.saved_tensors
+        B, C = x.shape[:2]
+        x32, weight32, bias32 = (t.to(torch.promote_types(t.dtype, torch.float32)) for t in (x, weight, bias))
+        y, _mean, _rstd = torch.native_group_norm(x32, weight32, bias32, B, C, x[0, 0].numel(), ctx.num_groups, ctx.eps)
+        sig = torch.sigmoid(y)
+        grad_y = y.mul_(1 - sig).add_(1).mul_(sig).mul_(grad_out) # silu'(y) = sig * (1 + y * (1 - sig)), in place on the recomputed y
+        grad_x, grad_weight, grad_bias = torch.ops.aten.native_group_norm_backward(
+            grad_y, x32, mean, rstd, weight32, B, C, x[0, 0].numel(), ctx.num_groups, [True, True, True])
+        return grad_x.to(x.dtype), None, grad_weight.to(weight.dtype), grad_bias.to(bias.dtype), None
+
+class StableNormSiLU(StableNorm):
+    '''
+    StableNorm followed by SiLU in one module (see GroupNormSiLU), with the same parameters and state dict keys as StableNorm.
+    '''
+    @classmethod
+    def from_norm(cls, norm):
+        # shares the GroupNorm (and so the parameters an optimizer may already hold) with the replaced StableNorm
+        module = cls(norm.norm.num_groups, norm.norm.num_channels)
+        module.norm = norm.norm
+        module.stats = norm.stats
+        return module
+
+    def forward(self, x):
+        if self.stats is not None: # tiled VAE inference
+            return F.silu(super().forward(x))
+        return GroupNormSiLU.apply(x, self.norm.num_groups, self.norm.weight, self.norm.bias, self.norm.eps)
+
+def fuse_norm_act(module):
+    '''
+    Replaces every StableNorm directly followed by nn.SiLU (ResBlock.norm1/act1 and norm2/act2, and the (StableNorm, SiLU) pairs of the
+    nn.Sequential heads of UNet, VAEEncoder and VAEDecoder) with StableNormSiLU and nn.Identity, in place. State dicts stay compatible.
+    '''
+    for child in list(module.modules()):
+        if isinstance(child, ResBlock):
+            pairs = [('norm1', 'act1'), ('norm2', 'act2')]
+        elif isinstance(child, nn.Sequential):
+            names = [name for name, _layer in child.named_children()]
+            pairs = list(zip(names[:-1], names[1:]))
+        else:
+            continue
+        for norm_name, act_name in pairs:
+            norm, act = getattr(child, norm_name), getattr(child, act_name)
+            if type(norm) is StableNorm and isinstance(act, nn.SiLU):
+                setattr(child, norm_name, StableNormSiLU.from_norm(norm))
+                setattr(child, act_name, nn.Identity())
+    return module
 
 class Downsample(nn.Module):
     def __init__(self, nc: int):
@@ -82,7 +157,120 @@ class Upsample(nn.Module):
         dtype = x.dtype
         return self.conv(F.interpolate(x.float(), size=(H*2, W*2), mode='nearest')).type(dtype)
 
-class MHA(nn.Module): # slightly faster and less mem than torch multihead attn (I suppose from QKV projection being fused)
+class SubPixelUpsample(nn.Module):
+    '''
+    Inference-time equivalent of Upsample that never materializes the 4x larger nearest-upsampled tensor. On that tensor, output pixel
+    (2i+a, 2j+b) of the 3x3 conv only reads the 2x2 input pixels starting at row i-1+a, column j-1+b, so one 2x2 conv on the
+    low resolution input with 4x the output channels (one set per phase (a, b)) computes every phase with 16 instead of 36 taps per output pixel,
+    and the phases are then interleaved (sub-pixel convolution / pixel shuffle).
+    '''
+    def __init__(self, nc: int):
+        '''
+        nc: number of input and output channels
+        '''
+        super().__init__()
+        self.nc = nc
+        self.conv = nn.Conv2d(nc, 4*nc, 2, padding=1)
+
+    @classmethod
+    @torch.no_grad()
+    def from_upsample(cls, upsample):
+        '''
+        Builds the SubPixelUpsample computing the same function as upsample (an Upsample).
+        Rows 0, 1, 2 of the 3x3 kernel read input rows i-1, i, i for a = 0 and i, i, i+1 for a = 1 (same for columns),
+        the kernel rows reading the same input row are summed into one row of the phase's 2x2 kernel.
+        '''
+        weight = upsample.conv.weight
+        nc = weight.shape[0]
+        module = cls(nc).to(device=weight.device, dtype=weight.dtype)
+        offsets = [[-1, 0, 0], [0, 0, 1]] # phase -> input row / column offset read by each kernel row / column
+        phase_weights = torch.zeros((nc, 2, 2, nc, 2, 2), device=weight.device, dtype=weight.dtype)
+        for a in range(2):
+            for b in range(2):
+                for ky, dy in enumerate(offsets[a]):
+                    for kx, dx in enumerate(offsets[b]):
+                        phase_weights[:, a, b, :, dy + 1 - a, dx + 1 - b] += weight[:, :, ky, kx]
+        module.conv.weight.copy_(phase_weights.reshape(4*nc, nc, 2, 2)) # output channel c*4 + a*2 + b is phase (a, b) of channel c
+        module.conv.bias.copy_(upsample.conv.bias.repeat_interleave(4))
+        return module
+
+    def forward(self, x):
+        B, _C, H, W = x.shape
+        y = self.conv(x) # B (C 2 2) (H+1) (W+1), phase (a, b) of output pixel (2i+a, 2j+b) is at row i+a, column j+b
+        sB, sC, sH, sW = y.stride()
+        phases = y.as_strided((B, self.nc, H, 2, W, 2), (sB, 4*sC, sH, 2*sC + sH, sW, sC + sW), y.storage_offset())
+        memory_format = torch.channels_last if sC == 1 else torch.contiguous_format # keep the input's layout
+        out = torch.empty((B, self.nc, 2*H, 2*W), dtype=y.dtype, device=y.device, memory_format=memory_format)
+        out.view(B, self.nc, H, 2, W, 2).copy_(phases) # the interleaving is the only copy
+        return out
+
+def fold_upsamples(module):
+    '''
+    Replaces every Upsample in module (e.g. a UNet or vae.decoder) with the equivalent SubPixelUpsample, in place.
+    For inference only: the folded weights have a different shape, so save checkpoints from the unfolded model.
+    '''
+    for name, child in module.named_children():
+        if isinstance(child, Upsample):
+            setattr(module, name, SubPixelUpsample.from_upsample(child))
+        else:
+            fold_upsamples(child)
+    return module
+
+def attention_chunk_sizes(B, H, Nq, Nk, element_size, memory_budget):
+    '''
+    Largest (query chunk, key chunk) sizes whose attention scores fit in memory_budget bytes.
+    Keys are only chunked when even 128 queries against all keys do not fit.
+    '''
+    pair_bytes = B * H * element_size * 3 # scores, probabilities and a temporary per (query, key) pair
+    if Nq * Nk * pair_bytes <= memory_budget:
+        return Nq, Nk
+    kv_chunk = Nk if 128 * Nk * pair_bytes <= memory_budget else max(memory_budget // (128 * pair_bytes), 1)
+    q_chunk = max(memory_budget // (kv_chunk * pair_bytes), 1)
+    return min(q_chunk, Nq), min(kv_chunk, Nk)
+
+def chunked_attention(q, k, v, memory_budget):
+    '''
+    Exact attention with bounded peak memory: queries are processed in chunks, and keys/values in chunks with an online softmax
+    (running max and normalizer, as in FlashAttention) when a query chunk against all keys would not fit in memory_budget bytes.
+    q, k, v: (B, H, N, D) like F.scaled_dot_product_attention
+    '''
+    B, H, Nq, D = q.shape
+    Nk = k.shape[2]
+    q_chunk, kv_chunk = attention_chunk_sizes(B, H, Nq, Nk, max(q.element_size(), 4), memory_budget)
+    if kv_chunk == Nk: # one softmax pass per query chunk
+        return torch.cat([F.scaled_dot_product_attention(q[:, :, i:i+q_chunk], k, v) for i in range(0, Nq, q_chunk)], dim=2)
+
+    out = torch.empty_like(q)
+    scale = D ** -0.5
+    for i in range(0, Nq, q_chunk):
+        q_i = q[:, :, i:i+q_chunk].float() * scale
+        running_max = torch.full(q_i.shape[:-1] + (1,), float('-inf'), device=q.device)
+        normalizer = torch.zeros_like(running_max)
+        acc = torch.zeros_like(q_i)
+        for j in range(0, Nk, kv_chunk):
+            scores = q_i @ k[:, :, j:j+kv_chunk].float().transpose(-1, -2)
+            new_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+            correction = torch.exp(running_max - new_max)
+            probs = torch.exp(scores - new_max)
+            normalizer = normalizer * correction + probs.sum(dim=-1, keepdim=True)
+            acc = acc * correction + probs @ v[:, :, j:j+kv_chunk].float()
+            running_max = new_max
+        out[:, :, i:i+q_chunk] = (acc / normalizer).to(q.dtype)
+    return out
+
+def set_attention_backend(module, backend, memory_budget=256 * 2**20):
+    '''
+    Selects the attention implementation of every MHA in module (e.g. vae.decoder to decode large images on CPU).
+    backend: 'default' (flash attention / F.scaled_dot_product_attention over the whole sequence) or 'chunked' (chunked_attention)
+    memory_budget: bytes the attention scores of one chunk may take in the chunked backend
+    '''
+    assert backend in ('default', 'chunked')
+    for submodule in module.modules():
+        if isinstance(submodule, MHA):
+            submodule.attn_backend = backend
+            submodule.memory_budget = memory_budget
+
+class MHA(nn.Module): # slightly faster and less mem than torch multihead attn (from the QKV / KV projections being fused)
     def __init__(self, nc: int, nh: int, kv_dim: int = None, zero_last_layer: bool = False):
         '''
         nc: number of input and output channels
@@ -93,36 +281,117 @@ class MHA(nn.Module): # slightly faster and less mem than torch multihead attn (
         super().__init__()
         self.nh = nh
         self.dhead = nc // nh
-        
-        kv_dim = nc if kv_dim is None else kv_dim
-        self.q_in = nn.Linear(nc, nc, bias=False)
-        self.k_in = nn.Linear(kv_dim, nc, bias=False)
-        self.v_in = nn.Linear(kv_dim, nc, bias=False)
+        self.cross = kv_dim is not None
+
+        # one packed GEMM for q, k and v (self-attention) or k and v (cross-attention)
+        if self.cross:
+            self.q_in = nn.Linear(nc, nc, bias=False)
+            self.kv_in = nn.Linear(kv_dim, 2*nc, bias=False)
+        else:
+            self.qkv_in = nn.Linear(nc, 3*nc, bias=False)
         self.out = nn.Linear(nc, nc, bias=False)
         if zero_last_layer:
             self.out = zero_module(self.out)
-    
-    def split_heads(self, x):
-        B, L, E = x.shape
+        self.kv_cache = {} # id(kv) -> (kv, k, v), only filled through cache_kv (used for the fixed text context during sampling)
+        self.attn_backend = 'default' # or 'chunked', see set_attention_backend
+        self.memory_budget = None
+        self._register_load_state_dict_pre_hook(self.pack_projections)
+
+    def pack_projections(self, state_dict, prefix, *args):
+        # checkpoints from before the fused layout have separate q_in / k_in / v_in weights, pack them on load (their optimizer state: pack_optimizer_state)
+        names = ['k_in', 'v_in'] if self.cross else ['q_in', 'k_in', 'v_in']
+        if all(f'{prefix}{name}.weight' in state_dict for name in names):
+            packed = torch.cat([state_dict.pop(f'{prefix}{name}.weight') for name in names])
+            state_dict[f'{prefix}{"kv_in" if self.cross else "qkv_in"}.weight'] = packed
+
+    def split_heads(self, x, n=1):
+        '''
+        Splits the packed projection x (B, L, n*E) into n views of shape (B, L, H, D) (flash attention) or (B, H, L, D) (SDPA), without copies.
+        '''
+        B, L, _E = x.shape
+        x = x.view(B, L, n, self.nh, self.dhead).unbind(dim=2) # M N (n H D) -> n x M N H D
         if ENABLE_FLASH_ATTN:
-            return x.reshape(B, L, self.nh, self.dhead) # M N (H D) -> M N H D, D=self.dhead, H=self.nh)
-        return x.reshape(B, L, self.nh, self.dhead).permute(0, 2, 1, 3).contiguous() # M N (H D) -> M H N D, D=self.dhead, H=self.nh
+            return x
+        return tuple(t.transpose(1, 2) for t in x) # M N H D -> M H N D
     
+    def cache_kv(self, kv):
+        '''
+        Projects kv once and reuses the keys/values whenever forward is called with this exact tensor again.
+        '''
+        k, v = self.split_heads(self.kv_in(kv), 2)
+        self.kv_cache[id(kv)] = (kv, k, v) # keep kv alive so its id can't be reused by another tensor
+
+    def clear_kv_cache(self):
+        self.kv_cache = {}
+
     def forward(self, q, kv=None):
         B, L, E = q.shape
-        if kv is None:
-            q, k, v = map(self.split_heads, (self.q_in(q), self.k_in(q), self.v_in(q)))
+        if not self.cross:
+            q, k, v = self.split_heads(self.qkv_in(q), 3)
         else:
-            q, k, v = map(self.split_heads, (self.q_in(q), self.k_in(kv), self.v_in(kv)))
+            cached = self.kv_cache.get(id(kv)) if self.kv_cache else None # no id lookup (a per-tensor guard under torch.compile) without cached contexts
+            if cached is not None and cached[0] is kv:
+                k, v = cached[1:]
+            else:
+                k, v = self.split_heads(self.kv_in(kv), 2)
+            q = self.split_heads(self.q_in(q))[0]
 
-        if ENABLE_FLASH_ATTN:
+        if self.attn_backend == 'chunked':
+            if ENABLE_FLASH_ATTN: # heads were split in the flash attention layout
+                q, k, v = (t.transpose(1, 2) for t in (q, k, v)) # M N H D -> M H N D
+            qkv = chunked_attention(q, k, v, self.memory_budget)
+            concatted = qkv.transpose(1, 2).reshape(B, L, E) # M H N D -> M N (H D)
+        elif ENABLE_FLASH_ATTN:
             qkv = flash_attn_func(q, k, v) # flash attention not on TPU
             concatted = qkv.reshape(B, L, E) # M N H D -> M N (H D)
         else:
             qkv = F.scaled_dot_product_attention(q, k, v) # flash attention not on TPU
-            concatted = qkv.permute(0, 2, 1, 3).reshape(B, L, E).contiguous() # M H N D -> M N (H D)
+            concatted = qkv.transpose(1, 2).reshape(B, L, E) # M H N D -> M N (H D)
         return self.out(concatted)
     
+def to_tokens(x):
+    '''
+    B C H W -> B (H W) C, a view of channels_last x (see UNet.set_channels_last), a single copy otherwise.
+    '''
+    B, C, H, W = x.shape
+    return x.permute(0, 2, 3, 1).reshape(B, H*W, C).contiguous() # no-op for channels_last x
+
+def from_tokens(x, H, W):
+    '''
+    B (H W) C -> B C H W, always a (channels_last strided) view.
+    '''
+    B, _L, C = x.shape
+    return x.view(B, H, W, C).permute(0, 3, 1, 2)
+
+def pack_optimizer_state(model, opt_state_dict):
+    '''
+    Converts the state dict of an optimizer over model.parameters() saved before MHA fused its projections (separate q_in / k_in / v_in
+    entries) to the fused layout, concatenating the per-parameter state tensors (e.g. Adam's exp_avg and exp_avg_sq) the same way
+    MHA.pack_projections concatenates the weights. State dicts already in the fused layout are returned unchanged.
+    '''
+    n_packed = [] # per parameter of model, the number of pre-fusion parameters it packs
+    for name, _param in model.named_parameters():
+        n_packed.append(3 if name.endswith('qkv_in.weight') else 2 if name.endswith('kv_in.weight') else 1)
+    old_idxs = [idx for group in opt_state_dict['param_groups'] for idx in group['params']]
+    if len(old_idxs) == len(n_packed):
+        return opt_state_dict
+    if len(old_idxs) != sum(n_packed):
+        raise Exception(f'Optimizer state has {len(old_idxs)} parameters, expected {len(n_packed)} (fused) or {sum(n_packed)} (pre-fusion).')
+
+    state, new_state, new_groups = opt_state_dict['state'], {}, []
+    new_idx, pos = 0, 0
+    for group in opt_state_dict['param_groups']:
+        new_params, group_end = [], pos + len(group['params'])
+        while pos < group_end:
+            entries = [state[idx] for idx in old_idxs[pos:pos + n_packed[new_idx]] if idx in state]
+            if len(entries) == n_packed[new_idx]: # parameters that were never stepped have no state
+                new_state[new_idx] = {k: torch.cat([e[k] for e in entries]) if torch.is_tensor(v) and v.dim() > 0 else v for k, v in entries[0].items()}
+            new_params.append(new_idx)
+            pos += n_packed[new_idx]
+            new_idx += 1
+        new_groups.append({**group, 'params': new_params})
+    return {'state': new_state, 'param_groups': new_groups}
+
 class Attn2d(nn.Module):
     def __init__(self, nc: int):
         '''
@@ -134,11 +403,9 @@ class Attn2d(nn.Module):
         self.attn = MHA(self.nc, max(self.nc // 128, 1)) # max head dim is 128
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        h = self.norm(x).reshape(B, C, H*W).permute(0, 2, 1) # B C H W -> B (H W) C
-        h = self.attn(h)
-        h = h.permute(0, 2, 1).reshape(B, C, H, W) # B (H W) C -> B C H W
-        return x + h
+        _B, _C, H, W = x.shape
+        h = self.attn(to_tokens(self.norm(x)))
+        return x + from_tokens(h, H, W) # the residual add writes the output in x's layout
 
 class SwiGLU(nn.Module):
     def __init__(self, in_c: int, nc: int, bias: bool = False):
@@ -149,6 +416,53 @@ class SwiGLU(nn.Module):
     def forward(self, x):
         return self.lin(x) * F.silu(self.gate(x))
 
+def bipartite_soft_matching(metric, H, W, r, sx=2, sy=2):
+    '''
+    Token merging for Stable Diffusion (ToMe, Bolya & Hoffman, https://arxiv.org/abs/2303.17604).
+    The top-left token of every sy x sx window is a destination, the r source tokens most similar to a destination are averaged into it.
+    metric: (B, H*W, C) tokens the similarities are computed on
+    r: number of tokens to remove
+    returns: merge (B, H*W, C) -> (B, H*W - r, C) and unmerge (B, H*W - r, C) -> (B, H*W, C) functions
+    '''
+    B, N, _C = metric.shape
+    is_dst = torch.zeros((H, W), dtype=torch.bool, device=metric.device)
+    is_dst[::sy, ::sx] = True
+    is_dst = is_dst.flatten()
+    positions = torch.arange(N, device=metric.device)
+    dst_pos, src_pos = positions[is_dst], positions[~is_dst]
+    r = min(r, len(src_pos))
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_pos] @ metric[:, dst_pos].transpose(-1, -2) # B N_src N_dst
+        node_max, node_idx = scores.max(dim=-1) # best destination of every source
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None] # B N_src 1, most similar sources first
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r] # sources kept / merged (indices into the sources)
+        dst_idx = node_idx[..., None].gather(1, src_idx) # destination of every merged source
+        unm_pos, merged_pos = src_pos[unm_idx], src_pos[src_idx] # their positions in the full sequence
+
+    def merge(x):
+        C = x.shape[-1]
+        src, dst = x[:, src_pos], x[:, dst_pos]
+        unm = src.gather(1, unm_idx.expand(-1, -1, C))
+        src = src.gather(1, src_idx.expand(-1, -1, C))
+        dst = dst.scatter_reduce(1, dst_idx.expand(-1, -1, C), src, reduce='mean')
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        C = x.shape[-1]
+        n_unm = unm_idx.shape[1]
+        unm, dst = x[:, :n_unm], x[:, n_unm:]
+        out = torch.empty((B, N, C), dtype=x.dtype, device=x.device)
+        out[:, dst_pos] = dst
+        out.scatter_(1, unm_pos.expand(-1, -1, C), unm)
+        out.scatter_(1, merged_pos.expand(-1, -1, C), dst.gather(1, dst_idx.expand(-1, -1, C))) # merged sources get their destination's output
+        return out
+
+    return merge, unmerge
+
 class TransformerBlock(nn.Module):
     '''
     Attention between UNet feature maps and text embeddings.
@@ -169,18 +483,25 @@ class TransformerBlock(nn.Module):
             SwiGLU(d, 4*d, bias=False),
             nn.Linear(4*d, d, bias=False),
         )
+        self.tome_ratio = 0.0 # fraction of tokens merged for attn1 and ff (see bipartite_soft_matching), set through UNet.set_token_merging
 
     def forward(self, x, context=None):
-        B, C, H, W = x.shape
+        _B, _C, H, W = x.shape
         skip = x
-        x = x.reshape(B, C, H*W).permute(0, 2, 1).contiguous() # B C H W -> B (H W) C
-        x = self.attn1(self.norm1(x)) + x
+        x = to_tokens(x)
+        if self.tome_ratio > 0:
+            merge, unmerge = bipartite_soft_matching(x, H, W, int(H * W * self.tome_ratio))
+            x = unmerge(self.attn1(merge(self.norm1(x)))) + x
+        else:
+            x = self.attn1(self.norm1(x)) + x
         if context is not None:
             x = self.attn2(self.norm2(x), context) + x
-        x = self.ff(self.norm3(x)) + x
-        x = x.permute(0, 2, 1).reshape(B, C, H, W).contiguous() # B (H W) C -> B C H W
+        if self.tome_ratio > 0:
+            x = unmerge(self.ff(merge(self.norm3(x)))) + x
+        else:
+            x = self.ff(self.norm3(x)) + x
 
-        return x + skip
+        return skip + from_tokens(x, H, W) # the residual add writes the output in skip's layout, no separate copy back
 
 class TimeEmbedding(nn.Module):
     '''
@@ -1,4 +1,6 @@
-from modules.layers import ResBlock, Downsample, Upsample, Attn2d, TransformerBlock, TimeEmbedding, StableNorm
+from modules.layers import ResBlock, Downsample, Upsample, SubPixelUpsample, Attn2d, TransformerBlock, TimeEmbedding, StableNorm
+from modules.cache import TextEmbeddingCache
+from modules.data import tokenize
 from transformers import CLIPTokenizerFast, CLIPTextModel
 from torchvision.models import vgg16, VGG16_Weights
 import torch.nn.functional as F
@@ -96,6 +98,147 @@ class VAEDecoder(nn.Module):
     def forward(self, x):
         return self.model(x)
     
+def tile_starts(size, tile_size, stride):
+    # start offsets of tiles of tile_size covering [0, size), the last tile is moved back to end at size
+    starts = list(range(0, max(size - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < size:
+        starts.append(size - tile_size)
+    return starts
+
+def feather_weights(size, overlap, ramp_start, ramp_end, device):
+    # 1 inside the tile, linear ramps over the overlap on the sides that border another tile
+    weights = torch.ones((size,), device=device)
+    ramp = torch.linspace(0, 1, overlap + 2, device=device)[1:-1]
+    if ramp_start and overlap > 0:
+        weights[:overlap] = ramp
+    if ramp_end and overlap > 0:
+        weights[-overlap:] = ramp.flip(0)
+    return weights
+
+def tile_weights(H, W, tile_size, overlap, in_factor, out_factor, device):
+    '''
+    Returns [(y, x, tile height, tile width, output space feather weights)] of every tile, y/x/height/width in input space.
+    '''
+    stride = tile_size - overlap
+    out_overlap = overlap * out_factor // in_factor
+    tiles = []
+    for y in tile_starts(H, tile_size, stride):
+        for x in tile_starts(W, tile_size, stride):
+            th, tw = min(tile_size, H - y), min(tile_size, W - x)
+            out_weights = feather_weights(th * out_factor // in_factor, out_overlap, y > 0, y + th < H, device)[:, None] \
+                    * feather_weights(tw * out_factor // in_factor, out_overlap, x > 0, x + tw < W, device)[None]
+            tiles.append((y, x, th, tw, out_weights))
+    return tiles
+
+def core_bounds(starts, tile_size, size, align):
+    # splits [0, size) among overlapping tiles at the middle of each overlap (rounded down to align), so every pixel belongs to exactly one tile
+    bounds = [0] + [(start + next_start + tile_size) // 2 // align * align for start, next_start in zip(starts[:-1], starts[1:])] + [size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class NormReached(Exception):
+    pass
+
+@torch.no_grad()
+def run_tiled(module, x, tile_size, overlap, in_factor, out_factor, stats_size=None, resume_bytes=256 * 2**20):
+    '''
+    Runs module (a VAEEncoder or VAEDecoder) on overlapping tiles of x and blends the outputs with feathered weights.
+    GroupNorm statistics are global so the tiles are normalized consistently. By default they are accumulated exactly, norm by norm in
+    execution order: one pass over the tiles per StableNorm sums the norm's input (in float64) over the part of every tile that
+    isn't covered by a neighbouring tile, with all earlier norms already frozen to their global statistics, and pauses the tiles there.
+    Paused tiles keep the activation they stopped at (up to resume_bytes in total, the others restart from their input next pass).
+    The mid-block attention only sees its own tile.
+    in_factor, out_factor: output size = input size * out_factor / in_factor
+    stats_size: None for the exact statistics, or the max side of a downscaled copy of x whose single pass estimates them (faster, approximate)
+    resume_bytes: memory for the activations of paused tiles in the exact statistics passes (more = less recomputation)
+    '''
+    B, _C, H, W = x.shape
+    if max(H, W) <= tile_size:
+        return module(x)
+    assert tile_size % in_factor == 0 and overlap % in_factor == 0, 'tile_size and overlap must be multiples of the downscale factor'
+    norms = [m for m in module.modules() if isinstance(m, StableNorm)]
+    tiles = tile_weights(H, W, tile_size, overlap, in_factor, out_factor, x.device)
+    stride = tile_size - overlap
+    ys, xs = tile_starts(H, tile_size, stride), tile_starts(W, tile_size, stride)
+    cores = [(cy, cx) for cy in core_bounds(ys, tile_size, H, in_factor) for cx in core_bounds(xs, tile_size, W, in_factor)] # same order as tiles
+
+    def record_stats(norm, args): # per (sample, group) mean and variance of the norm's input
+        x_groups = args[0].float().reshape(args[0].shape[0], norm.norm.num_groups, -1)
+        norm.stats = (x_groups.mean(dim=-1), x_groups.var(dim=-1, unbiased=False))
+
+    sums = {} # per tile pass: [sum, sum of squares, count] of the first norm without statistics
+    def accumulate_stats(norm, args):
+        if norm.stats is not None:
+            return
+        h = args[0]
+        (cy0, cy1), (cx0, cx1) = core
+        rows = slice((cy0 - y) * h.shape[2] // th, (cy1 - y) * h.shape[2] // th) # core region in the norm input's resolution
+        cols = slice((cx0 - x0) * h.shape[3] // tw, (cx1 - x0) * h.shape[3] // tw)
+        h_groups = h[:, :, rows, cols].double().reshape(h.shape[0], norm.norm.num_groups, -1)
+        acc = sums.setdefault(norm, [0, 0, 0])
+        acc[0] = acc[0] + h_groups.sum(dim=-1)
+        acc[1] = acc[1] + h_groups.square().sum(dim=-1)
+        acc[2] += h_groups.shape[-1]
+        raise NormReached # the rest of the tile needs this norm's global statistics
+
+    hooks = []
+    try:
+        if stats_size is not None:
+            # estimate on a downscaled copy (kept a multiple of in_factor so the encoder's shapes work out), the hooks
+            # freeze every norm's statistics as it is reached, the tiles then reuse them
+            hooks = [norm.register_forward_pre_hook(record_stats) for norm in norms]
+            scale = min(stats_size / max(H, W), 1.0)
+            preview_size = [max(int(side * scale) // in_factor * in_factor, in_factor) for side in (H, W)]
+            module(F.interpolate(x, size=preview_size, mode='area'))
+            for hook in hooks:
+                hook.remove()
+            hooks = []
+            outputs = [module(x[:, :, y:y+th, x0:x0+tw]) for y, x0, th, tw, _out_weights in tiles]
+        else:
+            # every tile keeps the input of the top-level layer it stopped in, so a pass resumes there instead of rerunning the tile
+            hooks = [norm.register_forward_pre_hook(accumulate_stats) for norm in norms]
+            layers = list(module.model)
+            resume = [(0, x[:, :, y:y+th, x0:x0+tw]) for y, x0, th, tw, _out_weights in tiles]
+            outputs = [None] * len(tiles)
+            while outputs[0] is None: # one pass per norm, the pass after the last norm finishes the tiles
+                sums, kept_bytes = {}, 0
+                for i, ((y, x0, th, tw, _out_weights), core) in enumerate(zip(tiles, cores)):
+                    start, h = resume[i]
+                    for layer_idx in range(start, len(layers)):
+                        try:
+                            h_next = layers[layer_idx](h)
+                        except NormReached:
+                            if kept_bytes + h.numel() * h.element_size() <= resume_bytes:
+                                resume[i] = (layer_idx, h)
+                                kept_bytes += h.numel() * h.element_size()
+                            else:
+                                resume[i] = (0, x[:, :, y:y+th, x0:x0+tw])
+                            break
+                        h = h_next
+                    else:
+                        outputs[i], resume[i] = h, None
+                for norm, (total, total_sq, count) in sums.items():
+                    mean = total / count
+                    norm.stats = (mean.float(), (total_sq / count - mean.square()).clamp(min=0).float())
+        for hook in hooks:
+            hook.remove()
+        hooks = []
+
+        out, weight_sum = None, None
+        for (y, x0, th, tw, out_weights), tile in zip(tiles, outputs):
+            if out is None:
+                out = torch.zeros((B, tile.shape[1], H * out_factor // in_factor, W * out_factor // in_factor), dtype=tile.dtype, device=tile.device)
+                weight_sum = torch.zeros(out.shape[-2:], dtype=tile.dtype, device=tile.device)
+            oy, ox = y * out_factor // in_factor, x0 * out_factor // in_factor
+            oh, ow = out_weights.shape
+            out[:, :, oy:oy+oh, ox:ox+ow] += tile * out_weights
+            weight_sum[oy:oy+oh, ox:ox+ow] += out_weights
+        return out / weight_sum
+    finally:
+        for hook in hooks:
+            hook.remove()
+        for norm in norms:
+            norm.stats = None
+
 class VAE(nn.Module):
     def __init__(
         self,
@@ -126,6 +269,60 @@ class VAE(nn.Module):
         eps = torch.randn_like(log_var)
         return mean + eps * std
 
+    @property
+    def downscale_factor(self):
+        return 2 ** (len(self.ch_mults) - 1)
+
+    def encode_tiled(self, x, tile_size=512, overlap=64, stats_size=None):
+        '''
+        Same result as self.encoder(x) (up to tiling error) with peak memory set by the tile size instead of the image size.
+        x: (B, 3, H, W) images
+        tile_size, overlap: in pixels, multiples of downscale_factor
+        stats_size: None for exact global GroupNorm statistics, or the max side of a downscaled image they are estimated on (faster, approximate)
+        '''
+        return run_tiled(self.encoder, x, tile_size, overlap, self.downscale_factor, 1, stats_size)
+
+    def decode_tiled(self, z, tile_size=64, overlap=8, stats_size=None):
+        '''
+        Same result as self.decoder(z) (up to tiling error) with peak memory set by the tile size instead of the latent size.
+        z: (B, nz, h, w) latents
+        tile_size, overlap: in latent pixels
+        stats_size: None for exact global GroupNorm statistics, or the max side of a downscaled latent they are estimated on (faster, approximate)
+        '''
+        return run_tiled(self.decoder, z, tile_size, overlap, 1, self.downscale_factor, stats_size)
+
+class LatentPreview(nn.Module):
+    '''
+    Per-pixel linear projection of the VAE latent channels to RGB, fitted to the VAE decoder's output.
+    Previews a latent at latent resolution for the cost of a 1x1 conv instead of a decoder pass.
+    '''
+    def __init__(self, nz: int = 4):
+        super().__init__()
+        self.nz = nz
+        self.register_buffer('weight', torch.zeros((3, nz)))
+        self.register_buffer('bias', torch.zeros((3,)))
+
+    @torch.no_grad()
+    def fit(self, vae, imgs, latent_scale=1.0):
+        '''
+        Least squares fit from the latent means of imgs to the decoded images average pooled to latent resolution.
+        vae: VAE
+        imgs: (B, 3, H, W) images in [-1, 1]
+        latent_scale: scale of the latents passed to forward relative to the VAE's (e.g. 1/1.2 if the sampler output is multiplied by 1.2 before decoding)
+        '''
+        mean, _log_var = torch.split(vae.encoder(imgs), vae.nz, dim=1)
+        rgb = F.adaptive_avg_pool2d(vae.decoder(mean), mean.shape[-2:])
+        z = (mean * latent_scale).permute(0, 2, 3, 1).reshape(-1, self.nz).double()
+        rgb = rgb.permute(0, 2, 3, 1).reshape(-1, 3).double()
+        solution = torch.linalg.lstsq(torch.cat([z, torch.ones_like(z[:, :1])], dim=1), rgb).solution # (nz+1, 3)
+        self.weight.copy_(solution[:-1].T)
+        self.bias.copy_(solution[-1])
+        return self
+
+    def forward(self, z):
+        # (B, nz, h, w) latents -> (B, 3, h, w) RGB in [-1, 1]
+        return F.conv2d(z, self.weight[:, :, None, None].to(z.dtype), self.bias.to(z.dtype)).clamp(-1, 1)
+
 class Discriminator(nn.Module):
     '''
     just a normal PatchGAN discriminator model - copied from https://github.com/CompVis/taming-transformers/blob/master/taming/modules/discriminator/model.py
@@ -171,12 +368,21 @@ class Discriminator(nn.Module):
 
 class FrozenCLIPEmbedder(nn.Module):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=64):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=64, cache_dir=None):
+        '''
+        cache_dir: directory of a persistent TextEmbeddingCache checked before running the transformer (None = no cache), embeddings read back from it are rounded to fp16
+        '''
         super().__init__()
         self.tokenizer = CLIPTokenizerFast.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version).to(device)
+        self.version = version
         self.device = device
         self.max_length = max_length
+        self._empty_embedding = None
+        self.cache = None
+        if cache_dir is not None:
+            embedding_shape = (max_length, self.transformer.config.hidden_size)
+            self.cache = TextEmbeddingCache(cache_dir, f'{version}:{max_length}', embedding_shape)
         self.freeze()
 
     def freeze(self):
@@ -184,24 +390,68 @@ class FrozenCLIPEmbedder(nn.Module):
         for param in self.parameters():
             param.requires_grad = False
 
-    def forward(self, text):
-        batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
-                                        return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-        tokens = batch_encoding["input_ids"].to(self.device)
-        outputs = self.transformer(input_ids=tokens)
+    def embed(self, text):
+        tokens = tokenize(self.tokenizer, text, self.max_length).to(self.device)
+        return self.embed_tokens(tokens)
+
+    def embed_tokens(self, input_ids):
+        outputs = self.transformer(input_ids=input_ids.to(self.device, non_blocking=True))
 
         z = outputs.last_hidden_state
         return z
 
+    def cached_embed(self, keys, inputs, embed_fn):
+        '''
+        Looks up keys in the cache, embeds the (deduplicated) missing inputs with embed_fn and stores them.
+        The cache stores fp16, so embeddings served from it are fp16-rounded, while the missing ones are returned at the
+        encoder's full precision (only the stored copy is rounded).
+        '''
+        unique_inputs = dict(zip(keys, inputs)) # deduplicates captions within the batch
+        found = {key: embedding.to(self.device, torch.float32) for key, embedding in self.cache.get(unique_inputs.keys()).items()}
+        missing = [key for key in unique_inputs if key not in found]
+        if missing != []:
+            embeddings = embed_fn([unique_inputs[key] for key in missing])
+            self.cache.put(missing, embeddings)
+            found.update(zip(missing, embeddings.float()))
+        return torch.stack([found[key] for key in keys])
+
+    def forward(self, text):
+        if self.cache is None:
+            return self.embed(text)
+
+        text = [text] if isinstance(text, str) else list(text)
+        keys = [self.cache.key(caption) for caption in text]
+        return self.cached_embed(keys, text, self.embed)
+
+    def encode_tokens(self, input_ids):
+        '''
+        Embeds captions that were already tokenized (e.g. in the dataloader workers by data.TokenizingCollate).
+        input_ids: (B, max_length) tensor
+        '''
+        if self.cache is None:
+            return self.embed_tokens(input_ids)
+
+        rows = list(input_ids.cpu())
+        keys = [self.cache.key('\0' + ' '.join(map(str, ids.tolist()))) for ids in rows] # \0 can't appear in captions, so id keys never collide with text keys
+        return self.cached_embed(keys, rows, lambda ids: self.embed_tokens(torch.stack(ids)))
+
+    def empty_embedding(self, batch_size=1):
+        '''
+        Embedding of the empty prompt (unconditional CFG input), computed once and reused.
+        '''
+        if self._empty_embedding is None:
+            self._empty_embedding = self([''])
+        return self._empty_embedding.expand(batch_size, -1, -1)
+
 class TimestepEmbedSequential(nn.Sequential):
     '''
     A sequential module that passes timestep embeddings to the children that
     support it as an extra input.
     '''
-    def forward(self, x, emb, context=None):
+    def forward(self, x, emb, context=None, step_idx=None):
         for layer in self:
             if isinstance(layer, (ResBlock)):
-                x = layer(x, emb)
+                x = layer(x, emb, step_idx)
             elif isinstance(layer, TransformerBlock):
                 x = layer(x, context)
             else:
@@ -273,17 +523,114 @@ class UNet(nn.Module):
             nn.SiLU(),
             nn.Conv2d(nc, self.in_c, 3, padding=1)
         )
+        self.memory_format = torch.contiguous_format # layout of the activations, see set_channels_last
+        self.cached_timesteps = None # see prepare_timestep_cache
+        self.timestep_cache_key = None
 
-    def forward(self, x, timesteps, context=None):
-        temb = self.time_embed(timesteps)
-        downs = []
+    def cache_context(self, *contexts):
+        '''
+        Precomputes the cross-attention keys/values of every TransformerBlock for the given context tensor(s).
+        Later forward calls with the same context tensor object skip the kv_in projection.
+        '''
+        for module in self.modules():
+            if isinstance(module, TransformerBlock):
+                for context in contexts:
+                    module.attn2.cache_kv(context)
+
+    def clear_context_cache(self):
+        for module in self.modules():
+            if isinstance(module, TransformerBlock):
+                module.attn2.clear_kv_cache()
+
+    def prepare_timestep_cache(self, timesteps):
+        '''
+        Evaluates the time embedding and every ResBlock's projection of it once for each scheduled timestep, so that
+        forward(..., step_idx=i) looks up row i of those tables instead of running the time embedding MLP and the temb_proj layers.
+        The tables are rebuilt on the next forward after a weight they depend on changes (optimizer step, load_state_dict, .to()).
+        timesteps: (n_steps,) tensor of the scheduled timesteps (e.g. Sampler.tau), step_idx indexes into it
+        '''
+        if self.cached_timesteps is not None and torch.equal(self.cached_timesteps.cpu(), timesteps.cpu()):
+            self.refresh_timestep_cache() # same schedule as the previous call, only rebuilt if the weights changed
+            return
+        self.cached_timesteps = timesteps
+        self.timestep_cache_key = None
+        self.temb_blocks = [module for module in self.modules() if isinstance(module, ResBlock)]
+        self.temb_params = list(self.time_embed.parameters()) + [p for block in self.temb_blocks for p in block.temb_proj.parameters()]
+        self.refresh_timestep_cache()
+
+    def refresh_timestep_cache(self):
+        # in-place updates bump a parameter's version, replacing or moving it changes its data pointer
+        key = tuple((p._version, p.data_ptr()) for p in self.temb_params)
+        if key == self.timestep_cache_key:
+            return
+        with torch.no_grad():
+            device = self.temb_params[0].device
+            temb = F.silu(self.time_embed(self.cached_timesteps.to(device)))
+            for block in self.temb_blocks:
+                block.temb_table = block.temb_proj(temb)
+        self.timestep_cache_key = key
+
+    def set_channels_last(self, enabled=True):
+        '''
+        Runs the UNet with channels_last (B H W C in memory) activations. Convolutions, norms, concatenations and up/downsampling
+        keep that layout, and the transformer blocks then read and write their (B, H*W, C) tokens as views instead of copying
+        the activations into and out of the token layout.
+        '''
+        self.memory_format = torch.channels_last if enabled else torch.contiguous_format
+        return self.to(memory_format=self.memory_format)
+
+    def set_token_merging(self, ratios):
+        '''
+        Sets the fraction of tokens merged before the self-attention and feed-forward of every TransformerBlock (ToMe).
+        ratios: one ratio per resolution level (index 0 = highest resolution, like attn_resolutions), 0 disables merging at that level
+        '''
+        level = 0
         for block in self.downs:
-            x = block(x, temb, context)
-            downs.append(x)
-        x = self.mid_block(x, temb, context)
+            for layer in block:
+                if isinstance(layer, TransformerBlock):
+                    layer.tome_ratio = ratios[level]
+            level += any(isinstance(layer, Downsample) for layer in block)
+        for layer in self.mid_block:
+            if isinstance(layer, TransformerBlock):
+                layer.tome_ratio = ratios[level]
         for block in self.ups:
+            for layer in block:
+                if isinstance(layer, TransformerBlock):
+                    layer.tome_ratio = ratios[level]
+            level -= any(isinstance(layer, (Upsample, SubPixelUpsample)) for layer in block)
+
+    def forward(self, x, timesteps, context=None, deep_cache=None, step_idx=None):
+        '''
+        deep_cache: DeepCache state shared by the calls of one sampling run (inference only), None computes every block
+        step_idx: index of the timestep (shared by the whole batch) in the timesteps given to prepare_timestep_cache, None computes the time embeddings
+        '''
+        x = x.contiguous(memory_format=self.memory_format)
+        if step_idx is None:
+            temb = self.time_embed(timesteps)
+        else:
+            self.refresh_timestep_cache()
+            temb = None
+        depth = 0 if deep_cache is None else deep_cache.depth
+        deep_features = None if deep_cache is None else deep_cache.get(x, context)
+        in_x = x
+
+        downs = []
+        for block in (self.downs if deep_features is None else self.downs[:depth]):
+            x = block(x, temb, context, step_idx)
+            downs.append(x)
+        if deep_features is None:
+            x = self.mid_block(x, temb, context, step_idx)
+            for block in self.ups[:len(self.ups)-depth]:
+                x = torch.cat([x, downs.pop()], dim=1)
+                x = block(x, temb, context, step_idx)
+            if deep_cache is not None:
+                deep_cache.put(x, in_x, context)
+        else:
+            x = deep_features
+        # the outer up blocks pop the outer down blocks' outputs
+        for block in self.ups[len(self.ups)-depth:]:
             x = torch.cat([x, downs.pop()], dim=1)
-            x = block(x, temb, context)
+            x = block(x, temb, context, step_idx)
         x = self.out(x)
 
         return x
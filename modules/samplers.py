@@ -23,43 +23,422 @@ class NoiseSchedule(nn.Module):
         noised = self.signal_stds[timesteps][:, None, None, None] * x + self.noise_stds[timesteps][:, None, None, None] * noise
         return noised, timesteps, noise
 
-class DDIMSampler():
+class GuidanceSchedule():
+    '''
+    Classifier-free guidance limited to a timestep interval (Kynkaanniemi et al., https://arxiv.org/abs/2404.07724),
+    outside of it only the conditional pass is run, saving one denoiser evaluation per step.
+    Pass it as cfg_weight to get_samples / iter_samples.
+    '''
+    def __init__(self, weight=3, t_min=0, t_max=None):
+        '''
+        weight: guidance weight, a number or a function of the (integer) timestep for a step-dependent weight
+        t_min, t_max: guidance is applied for timesteps in [t_min, t_max] (t_max None = up to the last timestep)
+        '''
+        self.weight = weight
+        self.t_min = t_min
+        self.t_max = t_max
+
+    def __call__(self, timestep):
+        # the weight at a timestep, 0 (conditional pass only) outside the interval
+        if timestep < self.t_min or (self.t_max is not None and timestep > self.t_max):
+            return 0
+        return self.weight(timestep) if callable(self.weight) else self.weight
+
+def progress(steps, verbose):
+    # tqdm only when verbose, so a silent sampling loop can be traced by torch.compile without graph breaks
+    return tqdm(steps) if verbose else steps
+
+class DeepCache():
+    '''
+    Inference state of UNet's deep feature caching (DeepCache, Ma et al., https://arxiv.org/abs/2312.00858).
+    The output of the deep part of the UNet (everything but the depth outermost down and up blocks) is computed every
+    interval calls and reused by the calls in between, which only run the outer blocks.
+    Features are kept per context tensor and input shape, so each CFG branch / batch chunk gets its own entry.
+    '''
+    def __init__(self, interval=3, depth=1):
+        '''
+        interval: number of calls a computed deep feature is used for (1 = no reuse)
+        depth: number of outer down/up blocks that are always recomputed (>= 1, downs[0] is the input conv)
+        '''
+        self.interval = interval
+        self.depth = depth
+        self.entries = {} # (id(context), x shape) -> [deep features, number of calls they were used for]
+
+    def get(self, x, context):
+        entry = self.entries.get((id(context), x.shape))
+        if entry is None or entry[1] % self.interval == 0:
+            return None
+        entry[1] += 1
+        return entry[0]
+
+    def put(self, features, x, context):
+        self.entries[(id(context), x.shape)] = [features, 1]
+
+    def clear(self):
+        self.entries = {}
+
+class Sampler():
+    '''
+    Base class of the samplers: handles the classifier-free guidance passes (split or batched) and context KV caching
+    around the sampler-specific loop in sample_loop.
+    '''
+    def __init__(self, denoiser,
+            noise_schedule=NoiseSchedule(),
+            cache_context=False,
+            batch_cfg=False,
+            max_batch_size=None,
+            deep_cache_interval=None,
+            deep_cache_depth=1,
+            cache_timesteps=False,
+        ):
+        '''
+        cache_context: precompute the denoiser's cross-attention keys/values of the context once per get_samples call (denoiser must have cache_context, e.g. UNet)
+        batch_cfg: run the conditional and unconditional CFG passes as one denoiser call on a doubled batch (needs uncond_context in get_samples)
+        max_batch_size: max number of samples per denoiser call in batch_cfg mode, larger doubled batches are run in chunks (None = no limit)
+        deep_cache_interval: recompute the denoiser's deep features every this many steps and reuse them in between (denoiser must accept deep_cache, e.g. UNet), None disables
+        deep_cache_depth: number of outer UNet down/up blocks recomputed every step when deep_cache_interval is set
+        cache_timesteps: look the time embeddings of the scheduled timesteps up in tables precomputed by the denoiser (denoiser must have prepare_timestep_cache, e.g. UNet)
+        '''
+        self.denoiser = denoiser
+        self.noise_schedule = noise_schedule
+        self.cache_context = cache_context
+        self.batch_cfg = batch_cfg
+        self.max_batch_size = max_batch_size
+        self.deep_cache_interval = deep_cache_interval
+        self.deep_cache = None if deep_cache_interval is None else DeepCache(deep_cache_interval, deep_cache_depth)
+        self.cache_timesteps = cache_timesteps
+
+    def get_cfg_batches(self, context, uncond_context, batch_size):
+        '''
+        Builds the (start, end, context) chunks of the doubled [conditional, unconditional] batch once per get_samples call,
+        each chunk holding at most max_batch_size samples.
+        '''
+        context = context.expand(batch_size, -1, -1)
+        uncond_context = uncond_context.expand(batch_size, -1, -1)
+        cfg_context = torch.cat([context, uncond_context])
+        chunk_size = 2*batch_size if self.max_batch_size is None else self.max_batch_size
+        return [(start, min(start + chunk_size, 2*batch_size), cfg_context[start:start + chunk_size]) for start in range(0, 2*batch_size, chunk_size)]
+
+    def predict_noise(self, x, timesteps, context=None, uncond_context=None, cfg_weight=None, cfg_batches=None, step_idx=None):
+        kwargs = {} if self.deep_cache is None else {'deep_cache': self.deep_cache}
+        if step_idx is not None:
+            kwargs['step_idx'] = step_idx
+        if cfg_weight in (0, None):
+            return self.denoiser(x, timesteps, context, **kwargs)
+        if cfg_batches is None:
+            return (1 + cfg_weight) * self.denoiser(x, timesteps, context, **kwargs) - cfg_weight * self.denoiser(x, timesteps, uncond_context, **kwargs)
+
+        x_in = torch.cat([x, x])
+        t_in = torch.cat([timesteps, timesteps])
+        noise_pred = torch.cat([self.denoiser(x_in[start:end], t_in[start:end], chunk_context, **kwargs) for start, end, chunk_context in cfg_batches])
+        cond_pred, uncond_pred = noise_pred.chunk(2)
+        return (1 + cfg_weight) * cond_pred - cfg_weight * uncond_pred
+
+    def iter_steps(self, x, predict_noise, verbose=True):
+        '''
+        Denoises x from pure noise, predict_noise(x, timesteps, timestep) returns the (guided) noise prediction
+        of the batch's timesteps tensor, timestep being the same timestep as a host int (so no device sync is needed to pick the guidance weight).
+        Yields (step, x_t, pred_x0) after every step, step counting the finished steps (tau_dim for the last one, where x_t is the sample).
+        verbose: show a progress bar
+        '''
+        raise NotImplementedError
+
+    def sample_loop(self, x, predict_noise, verbose=True):
+        for _step, x, _pred_x0 in self.iter_steps(x, predict_noise, verbose):
+            pass
+        return x
+
+    def prepare(self, initial_x, x_shape, context, cfg_weight, device, uncond_context):
+        '''
+        Returns the initial x, the predict_noise function of the sampling loop and whether the context keys/values were cached.
+        '''
+        if initial_x is None and x_shape is None:
+            raise Exception('Either initial_x or x_shape must be defined.')
+
+        x = torch.randn(x_shape, device=device) if initial_x is None else initial_x
+        cfg_batches = None
+        if self.batch_cfg and cfg_weight not in (0, None):
+            if context is None or uncond_context is None:
+                raise Exception('batch_cfg requires both context and uncond_context to be defined.')
+            cfg_batches = self.get_cfg_batches(context, uncond_context, x.shape[0])
+
+        cache_context = self.cache_context and context is not None and hasattr(self.denoiser, 'cache_context')
+        if cache_context:
+            if cfg_batches is None:
+                self.denoiser.cache_context(*[c for c in (context, uncond_context) if c is not None])
+            else: # the conditional context alone is used by the steps a GuidanceSchedule leaves unguided
+                guided_contexts = [chunk_context for _start, _end, chunk_context in cfg_batches]
+                self.denoiser.cache_context(*(guided_contexts + [context] if isinstance(cfg_weight, GuidanceSchedule) else guided_contexts))
+
+        step_idxs = {} # host timestep -> row of the denoiser's timestep tables
+        if self.cache_timesteps and hasattr(self.denoiser, 'prepare_timestep_cache'):
+            self.denoiser.prepare_timestep_cache(torch.from_numpy(self.tau).long().to(x.device))
+            step_idxs = {int(t): i for i, t in enumerate(self.tau)}
+
+        if isinstance(cfg_weight, GuidanceSchedule):
+            predict_noise = lambda x, timesteps, timestep: self.predict_noise(x, timesteps, context, uncond_context, cfg_weight(timestep), cfg_batches, step_idxs.get(int(timestep)))
+        else:
+            predict_noise = lambda x, timesteps, timestep: self.predict_noise(x, timesteps, context, uncond_context, cfg_weight, cfg_batches, step_idxs.get(int(timestep)))
+        return x, predict_noise, cache_context
+
+    def clear_caches(self, cache_context):
+        # frees the cached context keys/values and deep features once sampling ends
+        if cache_context:
+            self.denoiser.clear_context_cache()
+        if self.deep_cache is not None:
+            self.deep_cache.clear()
+
+    def get_samples(self, initial_x=None, x_shape=None, context=None, verbose=True, cfg_weight=3, device=None, uncond_context=None):
+        '''
+        cfg_weight: guidance weight (0 or None = conditional pass only) or a GuidanceSchedule
+        uncond_context: conditioning of the unconditional CFG pass (e.g. FrozenCLIPEmbedder.empty_embedding()), None runs it without cross-attention
+        '''
+        x, predict_noise, cache_context = self.prepare(initial_x, x_shape, context, cfg_weight, device, uncond_context)
+        try:
+            return self.sample_loop(x, predict_noise, verbose)
+        finally:
+            self.clear_caches(cache_context)
+
+    def iter_samples(self, initial_x=None, x_shape=None, context=None, verbose=True, cfg_weight=3, device=None, uncond_context=None, interval=1):
+        '''
+        Generator version of get_samples, yields (step, x_t, pred_x0) every interval steps and after the last step (x_t is then the sample).
+        Closing the generator early (e.g. a cancelled request) stops the sampling and frees the cached context.
+        interval: number of steps between yields
+        '''
+        x, predict_noise, cache_context = self.prepare(initial_x, x_shape, context, cfg_weight, device, uncond_context)
+        try:
+            for step, x_t, pred_x0 in self.iter_steps(x, predict_noise, verbose):
+                if step % interval == 0 or step == self.tau_dim:
+                    yield step, x_t, pred_x0
+        finally:
+            self.clear_caches(cache_context)
+
+class DDIMSampler(Sampler):
     def __init__(self, denoiser,
             noise_schedule=NoiseSchedule(),
             tau_dim=None,
             eta=0.0,
+            **kwargs
         ):
+        '''
+        kwargs: cache_context, batch_cfg, max_batch_size, deep_cache_interval, deep_cache_depth, cache_timesteps (see Sampler)
+        '''
+        super().__init__(denoiser, noise_schedule, **kwargs)
         device = noise_schedule.alpha_prods.device
-        self.denoiser = denoiser
-        self.noise_schedule = noise_schedule
         self.tau_dim = noise_schedule.t if tau_dim is None else tau_dim
         self.tau = np.linspace(0, self.noise_schedule.t-1, self.tau_dim).astype(np.int32)
-        self.eta = torch.ones((), device=device) * eta
+        self.eta = eta
 
         self.alphas = torch.cat([torch.ones((1,)).to(device), self.noise_schedule.alpha_prods[self.tau]])
-        self.betas = 1 - self.alphas
+
+        # per-step coefficients of x_{t-1} = x_scale * x_t + eps_scale * noise_pred + sigma * z (entry t-1 is the step t -> t-1),
+        # computed once in float64 so the loop is only elementwise ops on the device
+        alphas = self.alphas.double()
+        alpha_prev, alpha = alphas[:-1], alphas[1:]
+        sigmas = eta * ((1 - alpha_prev) / (1 - alpha) * (1 - alpha / alpha_prev))**0.5
+        self.x_scales = (alpha_prev / alpha)**0.5
+        self.eps_scales = (1 - alpha_prev - sigmas**2)**0.5 - (alpha_prev * (1 - alpha) / alpha)**0.5
+        self.sigmas = sigmas
+        # pred_x0 = x0_scale * x_t - x0_eps_scale * noise_pred, only used by iter_steps
+        self.x0_scales = alpha**-0.5
+        self.x0_eps_scales = ((1 - alpha) / alpha)**0.5
+        self.x_scales, self.eps_scales, self.sigmas, self.x0_scales, self.x0_eps_scales = [
+            table.float() for table in (self.x_scales, self.eps_scales, self.sigmas, self.x0_scales, self.x0_eps_scales)]
+        self.timesteps = torch.from_numpy(self.tau).long().to(device)
 
     def denoise_step(self, x, t, noise_pred):
-        beta_ratio = self.betas[t-1] / self.betas[t]
-        alpha_ratio = self.alphas[t] / self.alphas[t-1]
-        sigma = self.eta * (beta_ratio * (1 - alpha_ratio))**0.5
-        x0_step = self.alphas[t]**-0.5 * (x - self.betas[t]**0.5 * noise_pred)
-        xt_step = (1 - self.alphas[t-1] - sigma**2)**0.5 * noise_pred
-        added_noise = sigma * torch.randn_like(x)
-        return self.alphas[t-1]**0.5 * x0_step + xt_step + added_noise
-
-    def get_samples(self, initial_x=None, x_shape=None, context=None, verbose=True, cfg_weight=3, device=None):
-        if initial_x is None and x_shape is None:
-            raise Exception('Either initial_x or x_shape must be defined.')
+        '''
+        t: step index in [1, tau_dim] (int or 0-dim tensor), the step goes from tau[t-1] to tau[t-2] (the clean sample for t = 1)
+        '''
+        x = self.x_scales[t-1] * x + self.eps_scales[t-1] * noise_pred
+        if self.eta > 0:
+            x = x + self.sigmas[t-1] * torch.randn_like(x)
+        return x
 
-        x = torch.randn(x_shape, device=device) if initial_x is None else initial_x
-        for t in tqdm(range(self.tau_dim, 0, -1)):
-            t = torch.Tensor((t,)).long().to(x.device)
-            t_repeated = self.tau[t-1] * torch.ones(x.shape[:1], dtype=int).to(x.device)
+    def to(self, device):
+        # moves the step tables, a no-op if they are already on the device
+        if self.timesteps.device != torch.device(device):
+            self.x_scales, self.eps_scales, self.sigmas, self.x0_scales, self.x0_eps_scales, self.timesteps = [
+                table.to(device) for table in (self.x_scales, self.eps_scales, self.sigmas, self.x0_scales, self.x0_eps_scales, self.timesteps)]
+        return self
 
-            if cfg_weight in (0, None):
-                noise_pred = self.denoiser(x, t_repeated, context)
-            else:
-                noise_pred = (1 + cfg_weight) * self.denoiser(x, t_repeated, context) - cfg_weight * self.denoiser(x, t_repeated)
+    def sample_loop(self, x, predict_noise, verbose=True):
+        self.to(x.device)
+        timesteps = self.timesteps[:, None].expand(-1, x.shape[0]) # row t-1 holds the batch's timesteps of step t
+        for t in progress(range(self.tau_dim, 0, -1), verbose):
+            noise_pred = predict_noise(x, timesteps[t-1], self.tau[t-1])
             x = self.denoise_step(x, t, noise_pred)
         return x
+
+    def iter_steps(self, x, predict_noise, verbose=True):
+        self.to(x.device)
+        timesteps = self.timesteps[:, None].expand(-1, x.shape[0])
+        for t in progress(range(self.tau_dim, 0, -1), verbose):
+            noise_pred = predict_noise(x, timesteps[t-1], self.tau[t-1])
+            pred_x0 = self.x0_scales[t-1] * x - self.x0_eps_scales[t-1] * noise_pred
+            x = self.denoise_step(x, t, noise_pred)
+            yield self.tau_dim - t + 1, x, pred_x0
+
+class DPMSolverSampler(Sampler):
+    '''
+    DPM-Solver++ multistep sampler (Lu et al., https://arxiv.org/abs/2211.01095) on the data (x0) prediction.
+    With the default log-SNR spacing it reaches DDIM-50 quality in about 15-20 steps (see scripts/compare_samplers.py).
+    '''
+    def __init__(self, denoiser,
+            noise_schedule=NoiseSchedule(),
+            tau_dim=20,
+            order=2,
+            spacing='logsnr',
+            **kwargs
+        ):
+        '''
+        tau_dim: number of denoising steps (= denoiser evaluations per CFG branch)
+        order: 1 (= DDIM), 2 or 3, the solver order reached once enough previous predictions exist
+        spacing: 'logsnr' spaces the timesteps uniformly in log-SNR, 'uniform' uniformly in t like DDIMSampler
+            (the big log-SNR jump of the last uniform steps makes the higher orders unstable below ~20 steps)
+        kwargs: cache_context, batch_cfg, max_batch_size, deep_cache_interval, deep_cache_depth, cache_timesteps (see Sampler)
+        '''
+        super().__init__(denoiser, noise_schedule, **kwargs)
+        assert order in (1, 2, 3)
+        assert spacing in ('logsnr', 'uniform')
+        self.order = order
+        all_alpha_prods = self.noise_schedule.alpha_prods.double().cpu().numpy()
+        if spacing == 'uniform':
+            self.tau = np.linspace(0, self.noise_schedule.t-1, tau_dim).astype(np.int32)
+        else:
+            all_lambdas = 0.5 * np.log(all_alpha_prods / (1 - all_alpha_prods))
+            target_lambdas = np.linspace(all_lambdas[0], all_lambdas[-1], tau_dim)
+            # nearest integer timesteps, the lowest log-SNR gap can be smaller than one timestep so duplicates are dropped
+            self.tau = np.unique(np.abs(all_lambdas[None] - target_lambdas[:, None]).argmin(axis=1)).astype(np.int32)
+        self.tau_dim = len(self.tau)
+
+        # index 0 is the clean sample (alpha_prod = 1), index i the i-th timestep of tau, like DDIMSampler.alphas
+        alpha_prods = np.concatenate([[1.0], all_alpha_prods[self.tau]])
+        self.signal_stds = alpha_prods ** 0.5
+        self.noise_stds = (1 - alpha_prods) ** 0.5
+        with np.errstate(divide='ignore'):
+            self.lambdas = np.log(self.signal_stds) - np.log(self.noise_stds) # log-SNR / 2, inf at index 0
+
+    def solver_step(self, x, s, t, x0_preds, order):
+        '''
+        Multistep update from index s to index t = s-1, x0_preds holds the data predictions at s, s+1, s+2 (newest first).
+        '''
+        lambdas, signal_stds, noise_stds = self.lambdas, self.signal_stds, self.noise_stds
+        h = lambdas[t] - lambdas[s]
+        phi = np.expm1(-h) # e^-h - 1, -1 for the last step to the clean sample
+        x_t = (noise_stds[t] / noise_stds[s]) * x - (signal_stds[t] * phi) * x0_preds[0]
+        if order == 1:
+            return x_t
+
+        r0 = (lambdas[s] - lambdas[s+1]) / h
+        d1_0 = (x0_preds[0] - x0_preds[1]) / r0
+        if order == 2:
+            return x_t - (0.5 * signal_stds[t] * phi) * d1_0
+
+        r1 = (lambdas[s+1] - lambdas[s+2]) / h
+        d1_1 = (x0_preds[1] - x0_preds[2]) / r1
+        d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+        d2 = (d1_0 - d1_1) / (r0 + r1)
+        return x_t + (signal_stds[t] * (phi / h + 1)) * d1 - (signal_stds[t] * ((phi + h) / h**2 - 0.5)) * d2
+
+    def iter_steps(self, x, predict_noise, verbose=True):
+        x0_preds = []
+        for s in progress(range(self.tau_dim, 0, -1), verbose):
+            t_repeated = torch.full(x.shape[:1], int(self.tau[s-1]), dtype=torch.long, device=x.device)
+            noise_pred = predict_noise(x, t_repeated, self.tau[s-1])
+            x0_preds = [(x - self.noise_stds[s] * noise_pred) / self.signal_stds[s]] + x0_preds[:self.order-1]
+
+            # lower orders while the history fills up and for the last steps (more stable with few steps)
+            order = min(self.order, len(x0_preds), s)
+            x = self.solver_step(x, s, s-1, x0_preds, order)
+            yield self.tau_dim - s + 1, x, x0_preds[0]
+
+class UniformSchedule():
+    '''
+    Timesteps uniformly spaced in t (what DDIMSampler uses).
+    '''
+    def __call__(self, n_steps, sigmas):
+        '''
+        n_steps: number of sigmas to return
+        sigmas: (T,) sigmas of the training timesteps, increasing with t
+        returns: (n_steps,) decreasing sigmas, the last sample's sigma (0) is appended by the sampler
+        '''
+        return sigmas[np.linspace(len(sigmas) - 1, 0, n_steps).round().astype(np.int64)]
+
+class QuadraticSchedule():
+    '''
+    Timesteps spaced quadratically in t (DDIM's "quad" skip), denser at low noise.
+    '''
+    def __call__(self, n_steps, sigmas):
+        return sigmas[((len(sigmas) - 1) * np.linspace(1, 0, n_steps)**2).round().astype(np.int64)]
+
+class KarrasSchedule():
+    '''
+    Sigmas spaced uniformly in sigma^(1/rho) (Karras et al., https://arxiv.org/abs/2206.00364), rho=7 is the paper's choice.
+    '''
+    def __init__(self, rho=7.0):
+        self.rho = rho
+
+    def __call__(self, n_steps, sigmas):
+        max_inv_rho, min_inv_rho = sigmas[-1] ** (1 / self.rho), sigmas[0] ** (1 / self.rho)
+        return (max_inv_rho + np.linspace(0, 1, n_steps) * (min_inv_rho - max_inv_rho)) ** self.rho
+
+class KarrasSampler(Sampler):
+    '''
+    Euler, Euler-ancestral and Heun samplers on the sigma (variance exploding) parametrization of the NoiseSchedule,
+    sigma_t = ((1 - alpha_prod_t) / alpha_prod_t)^0.5, with a pluggable step schedule.
+    The denoiser keeps seeing the variance preserving x_t = x / (1 + sigma^2)^0.5 at the integer training timesteps.
+    '''
+    def __init__(self, denoiser,
+            noise_schedule=NoiseSchedule(),
+            tau_dim=20,
+            method='euler',
+            step_schedule=KarrasSchedule(),
+            eta=1.0,
+            **kwargs
+        ):
+        '''
+        tau_dim: number of steps (denoiser evaluations per CFG branch: tau_dim for euler/euler_a, 2*tau_dim-1 for heun)
+        method: 'euler', 'euler_a' (ancestral, adds fresh noise every step) or 'heun' (2nd order)
+        step_schedule: UniformSchedule, QuadraticSchedule, KarrasSchedule or any callable (n_steps, sigmas) -> decreasing sigmas
+        eta: amount of ancestral noise for euler_a (0 = euler)
+        kwargs: cache_context, batch_cfg, max_batch_size, deep_cache_interval, deep_cache_depth, cache_timesteps (see Sampler)
+        '''
+        super().__init__(denoiser, noise_schedule, **kwargs)
+        assert method in ('euler', 'euler_a', 'heun')
+        self.method = method
+        self.step_schedule = step_schedule
+        self.eta = eta
+
+        alpha_prods = self.noise_schedule.alpha_prods.double().cpu().numpy()
+        train_sigmas = ((1 - alpha_prods) / alpha_prods) ** 0.5
+        # the denoiser only knows the training timesteps, so snap every sigma to the closest one (in log sigma) and drop duplicates
+        log_sigmas = np.log(step_schedule(tau_dim, train_sigmas))
+        self.tau = np.unique(np.abs(np.log(train_sigmas)[None] - log_sigmas[:, None]).argmin(axis=1))[::-1].astype(np.int32)
+        self.tau_dim = len(self.tau)
+        self.sigmas = np.concatenate([train_sigmas[self.tau], [0.0]]) # decreasing, sigmas[i] is the noise level of tau[i]
+
+    def predict_denoised(self, x, i, predict_noise):
+        t_repeated = torch.full(x.shape[:1], int(self.tau[i]), dtype=torch.long, device=x.device)
+        noise_pred = predict_noise(x / (1 + self.sigmas[i]**2)**0.5, t_repeated, self.tau[i])
+        return x - self.sigmas[i] * noise_pred
+
+    def iter_steps(self, x, predict_noise, verbose=True):
+        sigmas = self.sigmas
+        x = x * (1 + sigmas[0]**2)**0.5 # unit variance noise -> noise at sigma_max
+        for i in progress(range(self.tau_dim), verbose):
+            denoised = self.predict_denoised(x, i, predict_noise)
+            d = (x - denoised) / sigmas[i] # dx/dsigma
+            if self.method == 'euler_a':
+                sigma_up = min(sigmas[i+1], self.eta * (sigmas[i+1]**2 * (sigmas[i]**2 - sigmas[i+1]**2) / sigmas[i]**2)**0.5)
+                sigma_down = (sigmas[i+1]**2 - sigma_up**2)**0.5
+                x = x + d * (sigma_down - sigmas[i])
+                if sigma_up > 0:
+                    x = x + sigma_up * torch.randn_like(x)
+            elif self.method == 'heun' and sigmas[i+1] > 0: # the last step to sigma = 0 stays an euler step
+                x_next = x + d * (sigmas[i+1] - sigmas[i])
+                d_next = (x_next - self.predict_denoised(x_next, i+1, predict_noise)) / sigmas[i+1]
+                x = x + 0.5 * (d + d_next) * (sigmas[i+1] - sigmas[i])
+            else:
+                x = x + d * (sigmas[i+1] - sigmas[i])
+            yield i + 1, x / (1 + sigmas[i+1]**2)**0.5, denoised # x_t in the denoiser's (variance preserving) scale
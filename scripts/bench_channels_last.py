@@ -0,0 +1,54 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from torch.utils._python_dispatch import TorchDispatchMode
+from modules.models import UNetSD
+from collections import Counter
+import torch, time
+
+# bytes written by pure layout copies (clone / copy_ / _to_copy, e.g. .contiguous() or a reshape of a permuted tensor)
+# during one UNetSD forward pass, with contiguous (B C H W) and channels_last (B H W C) activations
+BATCH_SIZE = 2 # conditional + unconditional CFG pass
+LATENT_SIZE = 64 # 512px image
+CONTEXT_LEN = 64
+CONTEXT_DIM = 768
+N_WARMUP = 1
+N_STEPS = 3
+COPY_OPS = {'clone', 'copy_', '_to_copy'}
+
+class CopyCounter(TorchDispatchMode):
+    def __init__(self):
+        super().__init__()
+        self.bytes = Counter() # op name -> bytes written
+        self.calls = Counter()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        name = func.overloadpacket.__name__
+        if name in COPY_OPS:
+            self.bytes[name] += out.numel() * out.element_size()
+            self.calls[name] += 1
+        return out
+
+torch.manual_seed(0)
+with torch.no_grad():
+    model = UNetSD().eval()
+    x = torch.randn((BATCH_SIZE, model.in_c, LATENT_SIZE, LATENT_SIZE))
+    timesteps = torch.full((BATCH_SIZE,), 500)
+    context = torch.randn((BATCH_SIZE, CONTEXT_LEN, CONTEXT_DIM))
+
+    for channels_last in (False, True):
+        model.set_channels_last(channels_last)
+        with CopyCounter() as counter:
+            out = model(x, timesteps, context)
+        for _i in range(N_WARMUP):
+            model(x, timesteps, context)
+        tic = time.time()
+        for _i in range(N_STEPS):
+            model(x, timesteps, context)
+        ms = (time.time() - tic) * 1000 / N_STEPS
+
+        layout = 'channels_last' if channels_last else 'contiguous'
+        copies = ', '.join(f'{name} x{counter.calls[name]}' for name in sorted(counter.calls))
+        print(f'{layout:>13}: {sum(counter.bytes.values()) / 2**20:8.1f} MiB copied ({copies or "none"}), {ms:8.1f} ms / forward')
@@ -0,0 +1,37 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.layers import Attn2d, set_attention_backend
+from torch.nn.attention import sdpa_kernel, SDPBackend
+import subprocess, contextlib, resource, torch, time
+
+# peak memory (max RSS of a fresh process) and latency of the VAE mid-block attention (Attn2d, 512 channels) on CPU,
+# with the default attention over the whole sequence vs the chunked backend; the latent is 1/8 of the image size.
+# recent PyTorch versions pick a fused memory-efficient SDPA kernel on CPU, 'default-math' forces the math kernel
+# that materializes the (HW)x(HW) scores (what older versions and unsupported dtypes/shapes fall back to)
+CHANNELS = 512
+LATENT_SIZES = [64, 96, 128] # 512px, 768px, 1024px images
+BACKENDS = ['default', 'default-math', 'chunked', 'chunked-math']
+MEMORY_BUDGET = 256 * 2**20
+
+def run(backend, latent_size):
+    kernels = sdpa_kernel([SDPBackend.MATH]) if backend.endswith('-math') else contextlib.nullcontext()
+    with torch.no_grad(), kernels:
+        attn = Attn2d(CHANNELS).eval()
+        set_attention_backend(attn, backend.split('-')[0], MEMORY_BUDGET)
+        x = torch.randn((1, CHANNELS, latent_size, latent_size))
+        tic = time.time()
+        attn(x)
+        elapsed = time.time() - tic
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{backend:<14}{latent_size * 8:>6}px{elapsed:>10.2f} s{max_rss_mb:>10.0f} MB peak RSS')
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3: # child process of one measurement
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        for latent_size in LATENT_SIZES:
+            for backend in BACKENDS:
+                result = subprocess.run([sys.executable, __file__, backend, str(latent_size)], capture_output=True, text=True)
+                print(result.stdout.strip().splitlines()[-1] if result.returncode == 0 else f'{backend:<14}{latent_size * 8:>6}px failed (out of memory?)')
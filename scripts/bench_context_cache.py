@@ -0,0 +1,42 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.models import UNet
+import torch, time
+
+# per-step UNet latency on CPU with and without the cross-attention context KV cache
+BATCH_SIZE = 1
+LATENT_SIZE = 32
+CONTEXT_LEN = 64
+N_WARMUP = 2
+N_STEPS = 10
+CONFIGS = {
+    'UNet': dict(),
+    'UNetSDXL-small': dict(nc=64, ch_mults=[1, 2, 4], attn_resolutions=[0, 2, 10], context_dim=2048),
+}
+
+def time_steps(model, x, t, context):
+    for _i in range(N_WARMUP):
+        model(x, t, context)
+    tic = time.time()
+    for _i in range(N_STEPS):
+        model(x, t, context)
+    return (time.time() - tic) * 1000 / N_STEPS
+
+torch.manual_seed(0)
+with torch.no_grad():
+    for name, kwargs in CONFIGS.items():
+        model = UNet(**kwargs).eval()
+        x = torch.randn((BATCH_SIZE, model.in_c, LATENT_SIZE, LATENT_SIZE))
+        t = torch.full((BATCH_SIZE,), 500, dtype=torch.long)
+        context = torch.randn((BATCH_SIZE, CONTEXT_LEN, model.context_dim))
+
+        uncached_ms = time_steps(model, x, t, context)
+        model.cache_context(context)
+        cached_out = model(x, t, context)
+        cached_ms = time_steps(model, x, t, context)
+        model.clear_context_cache()
+        max_diff = (cached_out - model(x, t, context)).abs().max().item()
+
+        print(f'{name}: uncached {uncached_ms:.1f} ms/step, cached {cached_ms:.1f} ms/step, saving {uncached_ms - cached_ms:.1f} ms/step ({100 * (1 - cached_ms / uncached_ms):.1f}%), max abs diff {max_diff:.2e}')
@@ -0,0 +1,45 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.samplers import DeepCache
+from modules.models import UNet
+import torch, time
+
+# UNet latency of a full step vs a step reusing the cached deep features (DeepCache), and the resulting
+# average per-step latency of a sampling run at each refresh interval
+BATCH_SIZE = 1
+LATENT_SIZE = 32
+CONTEXT_LEN = 64
+N_WARMUP = 1
+N_STEPS = 5
+DEPTHS = [1, 2, 3]
+INTERVALS = [2, 3, 5]
+CONFIGS = {
+    'UNetSD': dict(in_c=4, nc=320, ch_mults=[1, 2, 4, 4], attn_resolutions=[1, 1, 1, 0], nlayers_per_res=2, context_dim=768),
+}
+
+def time_steps(model, x, t, context, deep_cache=None):
+    for _i in range(N_WARMUP):
+        model(x, t, context, deep_cache=deep_cache)
+    tic = time.time()
+    for _i in range(N_STEPS):
+        model(x, t, context, deep_cache=deep_cache)
+    return (time.time() - tic) * 1000 / N_STEPS
+
+torch.manual_seed(0)
+with torch.no_grad():
+    for name, kwargs in CONFIGS.items():
+        model = UNet(**kwargs).eval()
+        x = torch.randn((BATCH_SIZE, model.in_c, LATENT_SIZE, LATENT_SIZE))
+        t = torch.full((BATCH_SIZE,), 500, dtype=torch.long)
+        context = torch.randn((BATCH_SIZE, CONTEXT_LEN, model.context_dim))
+
+        full_ms = time_steps(model, x, t, context)
+        print(f'{name}: full step {full_ms:.1f} ms')
+        for depth in DEPTHS:
+            deep_cache = DeepCache(interval=N_WARMUP + N_STEPS + 2, depth=depth) # never refreshes during the timing
+            model(x, t, context, deep_cache=deep_cache)
+            cached_ms = time_steps(model, x, t, context, deep_cache)
+            speedups = ', '.join(f'interval {n}: {full_ms * n / (full_ms + (n - 1) * cached_ms):.2f}x' for n in INTERVALS)
+            print(f'  depth {depth}: cached step {cached_ms:.1f} ms ({full_ms / cached_ms:.1f}x), sampling speedup {speedups}')
@@ -0,0 +1,68 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.models import VAE, UNet, FrozenCLIPEmbedder
+from modules.samplers import NoiseSchedule, DDIMSampler, GuidanceSchedule
+import torch, time
+
+# compares guidance-interval CFG schedules against full CFG on a fixed prompt set with fixed seeds:
+# UNet evaluations (NFE, counted per sample) saved and the change of the decoded images relative to full CFG
+PROMPTS = [
+    'a photo of a cat sitting on a windowsill',
+    'a red sports car on a mountain road',
+    'a bowl of fruit on a wooden table',
+    'a lighthouse at sunset',
+    'an astronaut riding a horse',
+    'a watercolor painting of a forest',
+]
+SEED = 0
+TAU_DIM = 20
+CFG_WEIGHT = 5
+LATENT_SHAPE = (4, 32, 32)
+LATENT_MULT = 1.2 # test_ddpm_inference.py scales the sampler's latents by this before decoding
+VAE_CKPT = '../trained_models/vae_0029_stable_norm.pth'
+DDPM_CKPT = '../trained_models/ddpm_0044.pth'
+TEXT_CACHE_DIR = '../trained_models/text_cache'
+SCHEDULES = { # name -> cfg_weight passed to get_samples
+    'full cfg': CFG_WEIGHT,
+    'no cfg t<100': GuidanceSchedule(CFG_WEIGHT, t_min=100),
+    'no cfg t<250': GuidanceSchedule(CFG_WEIGHT, t_min=250),
+    'cfg t in [250, 750]': GuidanceSchedule(CFG_WEIGHT, t_min=250, t_max=750),
+    'linear ramp t>=250': GuidanceSchedule(lambda t: CFG_WEIGHT * t / 999, t_min=250),
+}
+
+if __name__ == '__main__':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    with torch.no_grad():
+        vae = VAE()
+        vae.load_state_dict(torch.load(VAE_CKPT, map_location='cpu')['vae_state_dict'])
+        vae = vae.to(device).eval()
+        ddpm = UNet()
+        ddpm.load_state_dict(torch.load(DDPM_CKPT, map_location='cpu')['ddpm_state_dict'])
+        ddpm = ddpm.to(device).eval()
+        text_embedder = FrozenCLIPEmbedder(device=device, cache_dir=TEXT_CACHE_DIR)
+
+        nfe = [0]
+        ddpm.register_forward_hook(lambda _module, args, _output: nfe.__setitem__(0, nfe[0] + args[0].shape[0]))
+        sampler = DDIMSampler(ddpm, NoiseSchedule().to(device), tau_dim=TAU_DIM, cache_context=True)
+        context = text_embedder(PROMPTS)
+        uncond_context = text_embedder.empty_embedding()
+        initial_x = torch.randn((len(PROMPTS), *LATENT_SHAPE), generator=torch.Generator().manual_seed(SEED)).to(device)
+
+        results = {}
+        for name, cfg_weight in SCHEDULES.items():
+            nfe[0] = 0
+            tic = time.time()
+            z = sampler.get_samples(initial_x=initial_x.clone(), context=context, verbose=False, cfg_weight=cfg_weight, uncond_context=uncond_context)
+            imgs = vae.decoder(z * LATENT_MULT).clamp(-1, 1)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            results[name] = (imgs, nfe[0] / len(PROMPTS), time.time() - tic)
+
+        ref_imgs, ref_nfe, _ref_time = results['full cfg']
+        print(f'{"schedule":<22}{"nfe/img":>9}{"saved":>8}{"time (s)":>10}{"abs diff":>10}{"psnr (db)":>11}')
+        for name, (imgs, nfe_per_img, elapsed) in results.items():
+            mse = ((imgs - ref_imgs) / 2).pow(2).mean().item() # images in [-1, 1] -> [0, 1]
+            psnr = float('inf') if mse == 0 else -10 * torch.log10(torch.tensor(mse)).item()
+            print(f'{name:<22}{nfe_per_img:>9.0f}{1 - nfe_per_img / ref_nfe:>8.0%}{elapsed:>10.2f}{(imgs - ref_imgs).abs().mean().item():>10.4f}{psnr:>11.2f}')
@@ -0,0 +1,49 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.layers import StableNorm, StableNormSiLU
+import torch.nn as nn
+import torch, time
+
+# StableNorm + nn.SiLU vs the fused StableNormSiLU on UNetSD-sized activations: inference latency, training step
+# (forward + backward) latency and the bytes of activations autograd keeps alive for the backward pass
+SHAPES = [(2, 320, 64, 64), (2, 640, 32, 32), (2, 1280, 16, 16)] # UNetSD ResBlock inputs for a 512px image, CFG batch
+N_WARMUP = 5
+N_STEPS = 10
+
+def timed(fn):
+    for _i in range(N_WARMUP):
+        fn()
+    tic = time.time()
+    for _i in range(N_STEPS):
+        fn()
+    return (time.time() - tic) * 1000 / N_STEPS
+
+def saved_bytes(module, x):
+    # size of the distinct tensors saved for backward (x itself included)
+    saved = {}
+    def pack(t):
+        saved[t.data_ptr()] = t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        module(x)
+    return sum(saved.values())
+
+torch.manual_seed(0)
+for shape in SHAPES:
+    norm = StableNorm(32, shape[1])
+    modules = {
+        'StableNorm + SiLU': nn.Sequential(norm, nn.SiLU()),
+        'StableNormSiLU': StableNormSiLU.from_norm(norm),
+    }
+    x = torch.randn(shape)
+    x_train = x.clone().requires_grad_()
+    grad = torch.randn(shape)
+    print(f'shape {shape}')
+    for name, module in modules.items():
+        with torch.no_grad():
+            inference_ms = timed(lambda: module(x))
+        train_ms = timed(lambda: module(x_train).backward(grad))
+        mib = saved_bytes(module, x_train) / 2**20
+        print(f'  {name:<18} inference {inference_ms:7.2f} ms, forward + backward {train_ms:7.2f} ms, saved for backward {mib:6.1f} MiB')
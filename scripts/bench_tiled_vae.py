@@ -0,0 +1,56 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.models import VAE
+import torch.nn.functional as F
+import subprocess, resource, torch, time
+
+# peak memory (max RSS of a fresh process) and latency of VAE decoding on CPU, untiled vs VAE.decode_tiled with exact and
+# estimated (stats_size) GroupNorm statistics, then the relative error of the tiled decodes against the untiled one
+LATENT_SIZES = [64, 96] # 512px, 768px images
+TILE_SIZE = 32
+OVERLAP = 8
+MODES = ['full', 'tiled', 'tiled-estimate']
+STATS_SIZE = 32 # stats_size of the tiled-estimate mode
+ERROR_LATENT_SIZE = 48
+
+def run(mode, latent_size):
+    torch.manual_seed(0)
+    with torch.no_grad():
+        vae = VAE().eval()
+        z = torch.randn((1, vae.nz, latent_size, latent_size))
+        tic = time.time()
+        if mode == 'full':
+            out = vae.decoder(z)
+        else:
+            out = vae.decode_tiled(z, TILE_SIZE, OVERLAP, STATS_SIZE if mode == 'tiled-estimate' else None)
+        elapsed = time.time() - tic
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{mode:<16}{out.shape[-1]:>6}px{elapsed:>10.2f} s{max_rss_mb:>10.0f} MB peak RSS')
+
+def check_error():
+    torch.manual_seed(0)
+    with torch.no_grad():
+        vae = VAE().eval()
+        for p in vae.parameters(): # random weights, the default init zeroes the residual branches
+            p.normal_(std=0.02)
+        latents = {
+            'smooth': F.interpolate(torch.randn((1, vae.nz, ERROR_LATENT_SIZE // 8, ERROR_LATENT_SIZE // 8)), size=(ERROR_LATENT_SIZE, ERROR_LATENT_SIZE), mode='bilinear'),
+            'noise': torch.randn((1, vae.nz, ERROR_LATENT_SIZE, ERROR_LATENT_SIZE)),
+        }
+        for name, z in latents.items():
+            full = vae.decoder(z)
+            for mode, stats_size in [('tiled', None), ('tiled-estimate', STATS_SIZE)]:
+                out = vae.decode_tiled(z, TILE_SIZE, OVERLAP, stats_size)
+                print(f'{name} latent, {mode}: relative error {((out - full).norm() / full.norm()).item():.4f}')
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3: # child process of one measurement
+        run(sys.argv[1], int(sys.argv[2]))
+    else:
+        for latent_size in LATENT_SIZES:
+            for mode in MODES:
+                result = subprocess.run([sys.executable, __file__, mode, str(latent_size)], capture_output=True, text=True)
+                print(result.stdout.strip().splitlines()[-1] if result.returncode == 0 else f'{mode:<16}{latent_size * 8:>6}px failed (out of memory?)')
+        check_error()
@@ -0,0 +1,49 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.models import UNetSD
+import torch, time
+
+# UNetSD forward latency at batch size 1 with the time embedding MLP and the ResBlock temb_proj layers computed every call
+# vs looked up in the tables of UNet.prepare_timestep_cache, and the latency of those layers alone
+LATENT_SIZE = 32 # small latents (previews, low-res passes) are where the per-step fixed costs matter the most
+CONTEXT_LEN = 64
+CONTEXT_DIM = 768
+TAU_DIM = 50
+N_WARMUP = 2
+N_STEPS = 10
+
+def timed(fn):
+    for _i in range(N_WARMUP):
+        fn()
+    tic = time.time()
+    for _i in range(N_STEPS):
+        fn()
+    return (time.time() - tic) * 1000 / N_STEPS
+
+torch.manual_seed(0)
+with torch.no_grad():
+    model = UNetSD().eval()
+    x = torch.randn((1, model.in_c, LATENT_SIZE, LATENT_SIZE))
+    context = torch.randn((1, CONTEXT_LEN, CONTEXT_DIM))
+    tau = torch.linspace(0, 999, TAU_DIM).long()
+    step_idx = TAU_DIM // 2
+    timesteps = tau[step_idx:step_idx+1]
+
+    tic = time.time()
+    model.prepare_timestep_cache(tau)
+    prepare_ms = (time.time() - tic) * 1000
+    temb_blocks = model.temb_blocks
+    def time_embeddings():
+        temb = torch.nn.functional.silu(model.time_embed(timesteps))
+        for block in temb_blocks:
+            block.temb_proj(temb)
+
+    temb_ms = timed(time_embeddings)
+    full_ms = timed(lambda: model(x, timesteps, context))
+    cached_ms = timed(lambda: model(x, timesteps, context, step_idx=step_idx))
+    max_diff = (model(x, timesteps, context) - model(x, timesteps, context, step_idx=step_idx)).abs().max().item()
+    print(f'tables for {TAU_DIM} timesteps built in {prepare_ms:.1f} ms ({len(temb_blocks)} ResBlocks)')
+    print(f'time embedding + temb_proj layers alone: {temb_ms:.2f} ms / step')
+    print(f'forward: {full_ms:.1f} ms -> {cached_ms:.1f} ms / step with the tables (max abs diff {max_diff:.2e})')
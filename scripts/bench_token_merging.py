@@ -0,0 +1,38 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.layers import TransformerBlock
+import torch, time
+
+# latency of the highest resolution UNetSD TransformerBlock (512px image = 64x64 latent = 4096 tokens) at several
+# token merging ratios, and how far the merged output is from the exact one
+BATCH_SIZE = 2 # conditional + unconditional CFG pass
+LATENT_SIZE = 64
+CHANNELS = 320
+CONTEXT_LEN = 64
+CONTEXT_DIM = 768
+N_WARMUP = 1
+N_STEPS = 5
+RATIOS = [0.0, 0.3, 0.5, 0.7]
+
+torch.manual_seed(0)
+with torch.no_grad():
+    block = TransformerBlock(CHANNELS, CONTEXT_DIM).eval()
+    # smooth features (like real UNet activations) rather than white noise, which has no similar tokens to merge
+    x = torch.nn.functional.interpolate(torch.randn((BATCH_SIZE, CHANNELS, LATENT_SIZE // 4, LATENT_SIZE // 4)), size=(LATENT_SIZE, LATENT_SIZE), mode='bilinear')
+    context = torch.randn((BATCH_SIZE, CONTEXT_LEN, CONTEXT_DIM))
+
+    exact = None
+    for ratio in RATIOS:
+        block.tome_ratio = ratio
+        for _i in range(N_WARMUP):
+            out = block(x, context)
+        tic = time.time()
+        for _i in range(N_STEPS):
+            out = block(x, context)
+        ms = (time.time() - tic) * 1000 / N_STEPS
+        if exact is None:
+            exact, exact_ms = out, ms
+        rel_err = ((out - exact).norm() / (exact - x).norm()).item() # relative to the block's residual update
+        print(f'ratio {ratio:.1f}: {ms:8.1f} ms ({exact_ms / ms:.2f}x), relative error of the block update {rel_err:.4f}')
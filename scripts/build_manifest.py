@@ -0,0 +1,60 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.data import Manifest
+from multiprocessing import Pool, cpu_count
+from PIL import Image
+from tqdm import tqdm
+import os
+
+# scans the dataset once in parallel (image headers only) and writes a validated, columnar manifest read by ImgTextDataset(manifest_dir=...)
+IMG_FOLDER_PATH = 'dataset/imgs'
+CAPTION_FILE = 'dataset/id_to_text.txt'
+MANIFEST_DIR = 'dataset/manifest'
+MIN_SIDE = 64 # images with a shorter side than this are dropped (should be >= the training crop size)
+SUPPORTED_MODES = ('RGB', 'RGBA', 'L', 'LA', 'P', 'PA', 'CMYK', 'YCbCr')
+N_PROCESSES = cpu_count()
+
+def scan_image(fname):
+    '''
+    Returns (width, height, mode, nbytes, problem) of an image, problem is None for usable images.
+    '''
+    path = f'{IMG_FOLDER_PATH}/{fname}'
+    try:
+        nbytes = os.path.getsize(path)
+        with Image.open(path) as img: # only parses the header
+            width, height = img.size
+            mode = img.mode
+    except Exception as e:
+        return 0, 0, '', 0, f'unreadable ({type(e).__name__}: {e})'
+
+    if mode not in SUPPORTED_MODES:
+        return width, height, mode, nbytes, f'unsupported mode {mode}'
+    if min(width, height) < MIN_SIDE:
+        return width, height, mode, nbytes, f'too small ({width}x{height})'
+    return width, height, mode, nbytes, None
+
+if __name__ == '__main__':
+    # same ordering as ImgTextDataset: fnames[i] is described by captions[i]
+    fnames = sorted(entry.name for entry in os.scandir(IMG_FOLDER_PATH) if entry.name.endswith(('jpg', 'png')))
+    captions = open(CAPTION_FILE).read().strip().split('\n')
+    assert len(fnames) == len(captions)
+
+    with Pool(N_PROCESSES) as pool:
+        results = list(tqdm(pool.imap(scan_image, fnames, chunksize=256), total=len(fnames)))
+
+    kept = [idx for idx, result in enumerate(results) if result[-1] is None]
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with open(f'{MANIFEST_DIR}/invalid.txt', 'w') as f:
+        for fname, result in zip(fnames, results):
+            if result[-1] is not None:
+                f.write(f'{fname}\t{result[-1]}\n')
+
+    widths, heights, modes, nbytes = ([results[idx][col] for idx in kept] for col in range(4))
+    Manifest.write(
+        MANIFEST_DIR, IMG_FOLDER_PATH,
+        [fnames[idx] for idx in kept], [captions[idx] for idx in kept],
+        widths, heights, modes, nbytes
+    )
+    print(f'Wrote manifest of {len(kept)} images to {MANIFEST_DIR}, dropped {len(fnames) - len(kept)} (see {MANIFEST_DIR}/invalid.txt)')
@@ -0,0 +1,73 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.samplers import NoiseSchedule, DDIMSampler, DPMSolverSampler, KarrasSampler, UniformSchedule, QuadraticSchedule, KarrasSchedule
+import torch, time
+
+# compares samplers at a given number of denoiser evaluations (NFE, which is what sampling latency scales with on a real UNet)
+# on data with a known optimal denoiser (a mixture of two gaussians per dimension), against a 1000-step DDIM reference from
+# the same initial noise. "err" is the per-sample distance to the reference (only meaningful for deterministic samplers),
+# "w1" the 1-D Wasserstein distance between the sample and reference distributions (also valid for ancestral samplers)
+MODE_MEAN = 1.0
+MODE_STD = 0.2
+N_SAMPLES = 4096
+NFE_COUNTS = [8, 10, 15, 20, 30, 50]
+
+class MixtureDenoiser:
+    '''
+    Exact noise prediction for data that is +-MODE_MEAN (equal weights) plus N(0, MODE_STD**2) noise in every dimension.
+    '''
+    def __init__(self, noise_schedule):
+        self.alpha_prods = noise_schedule.alpha_prods.double()
+        self.nfe = 0
+
+    def __call__(self, x, timesteps, context=None):
+        self.nfe += 1
+        alpha_prod = self.alpha_prods[timesteps.long()].view(-1, *[1] * (x.dim() - 1))
+        signal_std, noise_std = alpha_prod**0.5, (1 - alpha_prod)**0.5
+        x = x.double()
+        var = signal_std**2 * MODE_STD**2 + noise_std**2 # variance of x_t given the mixture component
+        logits = torch.stack([-(x - signal_std * m)**2 / (2 * var) for m in (MODE_MEAN, -MODE_MEAN)])
+        weights = logits.softmax(dim=0)
+        # E[x0 | x_t, component] = m + signal_std * MODE_STD**2 / var * (x_t - signal_std * m)
+        x0 = sum(w * (m + signal_std * MODE_STD**2 / var * (x - signal_std * m)) for w, m in zip(weights, (MODE_MEAN, -MODE_MEAN)))
+        return ((x - signal_std * x0) / noise_std).float()
+
+def run(sampler, x):
+    sampler.denoiser.nfe = 0
+    samples = sampler.get_samples(initial_x=x.clone(), cfg_weight=None)
+    return samples, sampler.denoiser.nfe
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    noise_schedule = NoiseSchedule()
+    denoiser = MixtureDenoiser(noise_schedule)
+    x = torch.randn((N_SAMPLES, 1))
+
+    reference, _nfe = run(DDIMSampler(denoiser, noise_schedule, tau_dim=1000), x)
+    karras = lambda n, method, schedule: KarrasSampler(denoiser, noise_schedule, tau_dim=n, method=method, step_schedule=schedule)
+    samplers = { # name -> function of the NFE budget
+        'ddim': lambda nfe: DDIMSampler(denoiser, noise_schedule, tau_dim=nfe),
+        'dpm++2m': lambda nfe: DPMSolverSampler(denoiser, noise_schedule, tau_dim=nfe, order=2),
+        'dpm++3m': lambda nfe: DPMSolverSampler(denoiser, noise_schedule, tau_dim=nfe, order=3),
+        'dpm++2m-t': lambda nfe: DPMSolverSampler(denoiser, noise_schedule, tau_dim=nfe, order=2, spacing='uniform'),
+        'euler-uniform': lambda nfe: karras(nfe, 'euler', UniformSchedule()),
+        'euler-quad': lambda nfe: karras(nfe, 'euler', QuadraticSchedule()),
+        'euler-karras': lambda nfe: karras(nfe, 'euler', KarrasSchedule()),
+        'euler_a-karras': lambda nfe: karras(nfe, 'euler_a', KarrasSchedule()),
+        'heun-uniform': lambda nfe: karras((nfe + 1) // 2, 'heun', UniformSchedule()),
+        'heun-quad': lambda nfe: karras((nfe + 1) // 2, 'heun', QuadraticSchedule()),
+        'heun-karras': lambda nfe: karras((nfe + 1) // 2, 'heun', KarrasSchedule()),
+    }
+    sorted_reference = reference.flatten().sort().values
+    print(f'{"sampler":<16}{"nfe":>6}{"err":>10}{"w1":>10}{"ms":>8}')
+    for name, make_sampler in samplers.items():
+        for nfe_budget in NFE_COUNTS:
+            sampler = make_sampler(nfe_budget)
+            start = time.perf_counter()
+            samples, nfe = run(sampler, x)
+            ms = (time.perf_counter() - start) * 1000
+            err = (samples - reference).abs().mean().item()
+            w1 = (samples.flatten().sort().values - sorted_reference).abs().mean().item()
+            print(f'{name:<16}{nfe:>6}{err:>10.5f}{w1:>10.5f}{ms:>8.1f}')
@@ -0,0 +1,46 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.data import ImgTextDataset, LatentStoreWriter
+from modules.models import VAE
+from torch.utils.data import DataLoader
+from multiprocessing import cpu_count
+from tqdm import tqdm
+import torch, glob
+
+# encodes the dataset once with the frozen VAE so train_ddpm.py can train from the latent store (LATENT_DIR) instead of images
+CROP_SIZE = 64
+BATCH_SIZE = 64
+SHARD_SIZE = 65536
+USE_MIXED = False
+IMG_FOLDER_PATH = 'dataset/imgs'
+CAPTION_FILE = 'dataset/id_to_text.txt'
+LATENT_DIR = 'dataset/latents'
+CKPT_DIR = ''
+
+if __name__ == '__main__':
+    vae_ckpt_paths = sorted(glob.glob(f'{CKPT_DIR}/vae_*.pth'))
+    if vae_ckpt_paths == []:
+        raise Exception(f'No VAE checkpoint found in {CKPT_DIR}/')
+    print(f'Loading VAE checkpoint from {vae_ckpt_paths[-1]}')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    vae = VAE()
+    vae.load_state_dict(torch.load(vae_ckpt_paths[-1], map_location='cpu')['vae_state_dict'])
+    vae = vae.to(device).eval()
+
+    dataset = ImgTextDataset(IMG_FOLDER_PATH, CAPTION_FILE, CROP_SIZE)
+    dataloader = DataLoader(dataset, BATCH_SIZE, shuffle=False, num_workers=cpu_count(), pin_memory=True)
+
+    writer = None
+    with torch.no_grad():
+        for imgs, captions in tqdm(dataloader):
+            imgs = imgs.to(device).float() / 127.5 - 1.0
+            with torch.autocast(device, enabled=USE_MIXED):
+                z_params = vae.encoder(imgs).float().cpu().numpy()
+            if writer is None:
+                writer = LatentStoreWriter(LATENT_DIR, len(dataset), z_params.shape[1:], SHARD_SIZE)
+            writer.add(z_params, list(captions))
+    writer.close()
+    print(f'Wrote {len(dataset)} latents of shape {writer.latent_shape} to {LATENT_DIR}')
@@ -0,0 +1,39 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.models import VAE, LatentPreview
+from modules.data import ImgTextDataset
+import torch.nn.functional as F
+import torch, glob
+
+# fits the latent -> RGB preview projection (LatentPreview) to a trained VAE and saves it next to the checkpoints,
+# use it with Sampler.iter_samples to show cheap previews of the intermediate predicted x0 while sampling
+CROP_SIZE = 256
+N_IMGS = 64
+LATENT_SCALE = 1 / 1.2 # test_ddpm_inference.py multiplies the sampler's latents by 1.2 before decoding
+IMG_FOLDER_PATH = 'dataset/imgs'
+CAPTION_FILE = 'dataset/id_to_text.txt'
+CKPT_DIR = ''
+
+if __name__ == '__main__':
+    vae_ckpt_paths = sorted(glob.glob(f'{CKPT_DIR}/vae_*.pth'))
+    if vae_ckpt_paths == []:
+        raise Exception(f'No VAE checkpoint found in {CKPT_DIR}/')
+    print(f'Loading VAE checkpoint from {vae_ckpt_paths[-1]}')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    vae = VAE()
+    vae.load_state_dict(torch.load(vae_ckpt_paths[-1], map_location='cpu')['vae_state_dict'])
+    vae = vae.to(device).eval()
+
+    dataset = ImgTextDataset(IMG_FOLDER_PATH, CAPTION_FILE, CROP_SIZE)
+    step = max(len(dataset) // N_IMGS, 1)
+    imgs = torch.stack([dataset[i][0] for i in range(0, len(dataset), step)[:N_IMGS]]).to(device).float() / 127.5 - 1.0
+
+    with torch.no_grad():
+        preview = LatentPreview(vae.nz).to(device).fit(vae, imgs, LATENT_SCALE)
+        mean, _log_var = torch.split(vae.encoder(imgs), vae.nz, dim=1)
+        target = F.adaptive_avg_pool2d(vae.decoder(mean), mean.shape[-2:])
+        print(f'Preview mean abs error vs decoder (in [-1, 1]): {(preview(mean * LATENT_SCALE) - target).abs().mean().item():.4f}')
+    torch.save({'latent_preview_state_dict': preview.state_dict()}, f'{CKPT_DIR}/latent_preview.pth')
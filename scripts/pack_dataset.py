@@ -0,0 +1,26 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.data import Manifest, write_packed_shards
+import glob
+
+# converts an img_folder_path/caption_file pair into the packed shard format read by PackedImgTextDataset
+IMG_FOLDER_PATH = 'dataset/imgs'
+CAPTION_FILE = 'dataset/id_to_text.txt'
+MANIFEST_DIR = None # pack the (validated) images of a scripts/build_manifest.py manifest instead of globbing IMG_FOLDER_PATH
+PACKED_DIR = 'dataset/packed'
+SHARD_BYTES = 2**30
+
+if __name__ == '__main__':
+    if MANIFEST_DIR is not None:
+        manifest = Manifest(MANIFEST_DIR)
+        img_fnames, captions = manifest.fnames, manifest.captions
+    else:
+        # same ordering as ImgTextDataset: img_fnames[i] is described by captions[i]
+        img_fnames = sorted(glob.glob(f'{IMG_FOLDER_PATH}/*jpg') + glob.glob(f'{IMG_FOLDER_PATH}/*png'))
+        captions = open(CAPTION_FILE).read().strip().split('\n')
+    assert len(img_fnames) == len(captions)
+
+    write_packed_shards(img_fnames, captions, PACKED_DIR, SHARD_BYTES)
+    print(f'Packed {len(img_fnames)} images into {PACKED_DIR}')
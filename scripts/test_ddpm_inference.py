@@ -4,6 +4,7 @@ sys.path.append('..') # for python file.py within ./scripts dir
 
 from modules.models import VAE, UNet, FrozenCLIPEmbedder
 from modules.samplers import NoiseSchedule, DDIMSampler
+from modules.inference import CompiledDDIMPipeline
 from PIL import Image
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
@@ -53,6 +54,10 @@ def get_loss_curve(img, ddpm, timesteps): # track DM's MSE loss of an image thro
 get_params = lambda model: sum(p.numel() for p in model.parameters())
 
 N_ROWS, N_COLS = 2, 4
+TEXT_CACHE_DIR = '../trained_models/text_cache' # persistent CLIP embedding cache, None to disable
+COMPILE = False # compile the UNet + DDIM step and the VAE decoder (see modules/inference.py)
+COMPILE_CACHE_DIR = '../trained_models/compile_cache' # persisted compile artifacts, reused by the next start
+WARMUP_SHAPES = [(N_ROWS * N_COLS, 4, 32, 32)] # latent shapes compiled at startup
 device = 'cuda'
 with torch.no_grad():
     with torch.amp.autocast(device):
@@ -99,7 +104,14 @@ with torch.no_grad():
 
         raise
 
-        text_embedder = FrozenCLIPEmbedder()
+        text_embedder = FrozenCLIPEmbedder(cache_dir=TEXT_CACHE_DIR)
+        sample, decode = sampler.get_samples, vae.decoder
+        if COMPILE:
+            tic = time.time()
+            pipeline = CompiledDDIMPipeline(sampler, vae.decoder, cache_dir=COMPILE_CACHE_DIR)
+            pipeline.warmup(WARMUP_SHAPES, context_len=text_embedder.max_length, cfg_weight=5, device=device, context_batch_size=1) # one prompt for the whole grid
+            sample, decode = pipeline.get_samples, pipeline.decode
+            print(f'Time to compile (warm-up): {time.time()-tic:.4f} s')
 
         while True:
             prompt = input('Enter prompt: ')
@@ -110,11 +122,11 @@ with torch.no_grad():
             print(f'Time for CLIP inference: {time.time()-tic:.4f} s')
 
             tic = time.time()
-            z = sampler.get_samples(initial_x=initial_x, context=text_embedding, cfg_weight=5) * 1.2
+            z = sample(initial_x=initial_x, context=text_embedding, cfg_weight=5) * 1.2
             print(f'Time for DM inference of {initial_x.shape} shape tensor: {time.time()-tic:.4f} s')
 
             tic = time.time()
-            ypred = vae.decoder(z)
+            ypred = decode(z)
             torch.cuda.synchronize()
             print(f'Time for VAE decoder inference of {z.shape} shape tensor: {time.time()-tic:.4f} s')
             #Image.fromarray((255*tn(ypred)).astype(np.uint8)).save('/tmp/ldm_img.png')
@@ -0,0 +1,57 @@
+import sys
+sys.path.append('.') # for python ./scripts/file.py
+sys.path.append('..') # for python file.py within ./scripts dir
+
+from modules.layers import Upsample, SubPixelUpsample, fold_upsamples
+from modules.models import VAE, UNet
+import copy, torch, time
+
+# checks that fold_upsamples leaves the outputs of Upsample, UNet and the VAE decoder unchanged (random weights, odd and
+# even sizes, contiguous and channels_last inputs), then times the VAE decoder's top resolution upsample before / after folding
+TOLERANCE = 1e-4 # relative to the output's max magnitude, the summed kernel taps change the fp32 rounding
+BENCH_CHANNELS = 128 # VAE() top resolution upsample: 128 channels, 256x256 -> 512x512
+BENCH_SIZE = 256
+N_STEPS = 5
+
+def check(name, reference, folded):
+    err = ((reference - folded).abs().max() / reference.abs().max()).item()
+    assert err < TOLERANCE, f'{name}: relative error {err:.2e}'
+    print(f'{name:<36} ok (relative error {err:.2e})')
+
+def randomize(module):
+    for p in module.parameters(): # the default init zeroes some convs, which would hide errors
+        p.normal_(std=0.05)
+    return module
+
+torch.manual_seed(0)
+with torch.no_grad():
+    for nc, H, W in [(8, 5, 7), (32, 16, 16), (64, 1, 3)]:
+        upsample = randomize(Upsample(nc))
+        sub_pixel = SubPixelUpsample.from_upsample(upsample)
+        x = torch.randn((2, nc, H, W))
+        check(f'Upsample({nc}) on {H}x{W}', upsample(x), sub_pixel(x))
+        check(f'Upsample({nc}) on {H}x{W} channels_last', upsample(x), sub_pixel(x.contiguous(memory_format=torch.channels_last)))
+
+    unet = randomize(UNet(nc=64, ch_mults=[1, 2, 2], attn_resolutions=[0, 1, 1], nlayers_per_res=1, context_dim=32)).eval()
+    x, timesteps, context = torch.randn((2, 4, 16, 16)), torch.tensor([10, 700]), torch.randn((2, 7, 32))
+    folded_unet = fold_upsamples(copy.deepcopy(unet))
+    assert not any(isinstance(m, Upsample) for m in folded_unet.modules())
+    check('UNet', unet(x, timesteps, context), folded_unet(x, timesteps, context))
+    unet.set_token_merging([0.5, 0, 0]) # set_token_merging recognizes the folded upsamples
+    folded_unet.set_token_merging([0.5, 0, 0])
+    check('UNet with token merging', unet(x, timesteps, context), folded_unet(x, timesteps, context))
+
+    vae = randomize(VAE(nc=32, ch_mults=[1, 2, 2], nlayers_per_res=1)).eval()
+    z = torch.randn((1, 4, 12, 12))
+    folded_decoder = fold_upsamples(copy.deepcopy(vae.decoder))
+    check('VAEDecoder', vae.decoder(z), folded_decoder(z))
+
+    upsample = randomize(Upsample(BENCH_CHANNELS))
+    sub_pixel = SubPixelUpsample.from_upsample(upsample)
+    x = torch.randn((1, BENCH_CHANNELS, BENCH_SIZE, BENCH_SIZE))
+    for name, module in [('Upsample', upsample), ('SubPixelUpsample', sub_pixel)]:
+        module(x)
+        tic = time.time()
+        for _i in range(N_STEPS):
+            module(x)
+        print(f'{name:<16} {BENCH_CHANNELS}ch {BENCH_SIZE}->{2*BENCH_SIZE}: {(time.time() - tic) * 1000 / N_STEPS:8.1f} ms')
@@ -3,9 +3,11 @@ sys.path.append('.') # for python ./scripts/file.py
 sys.path.append('..') # for python file.py within ./scripts dir
 
 from modules.losses import kl_divergence, adv_loss_fn, PercepLoss
+from modules.layers import pack_optimizer_state
 from modules.models import VAE, FrozenCLIPEmbedder, UNet
 from modules.samplers import NoiseSchedule, DDIMSampler
-from modules.data import ImgTextDataset
+from modules.data import ImgTextDataset, PackedImgTextDataset, StreamingImgTextDataset, LatentTextDataset, TokenizingCollate
+from modules.data import AspectRatioBucketSampler, make_buckets, set_epoch
 from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
@@ -35,6 +37,14 @@ BATCH_SIZE = 1
 USE_MIXED = False
 IMG_FOLDER_PATH = 'dataset/imgs'
 CAPTION_FILE = 'dataset/id_to_text.txt'
+MANIFEST_DIR = None # manifest written by scripts/build_manifest.py, replaces globbing IMG_FOLDER_PATH at startup when set
+BUCKET_BASE_SIZE = None # train on aspect ratio buckets of about BUCKET_BASE_SIZE**2 pixels instead of CROP_SIZE squares (needs MANIFEST_DIR)
+PACKED_DIR = None # packed shards written by scripts/pack_dataset.py, used instead of IMG_FOLDER_PATH/CAPTION_FILE when set
+STREAMING = False # stream PACKED_DIR shards sequentially (per rank/worker) instead of random reads through a DistributedSampler
+LATENT_DIR = None # latent store written by scripts/encode_latents.py, skips image decoding and the VAE encoder when set
+USE_VAE_DECODER = True # False (with LATENT_DIR) trains without loading the VAE, predictions are then not decoded/displayed
+TOKENIZE_IN_WORKERS = True # tokenize captions in the dataloader workers instead of the training process
+TEXT_CACHE_DIR = None # directory of the persistent CLIP text embedding cache (None = run CLIP on every caption)
 
 WANDB_RUN_PATH = WANDB_MODEL_FNAME = None
 #WANDB_VAE_RUN_PATH = WANDB_VAE_MODEL_FNAME = None
@@ -48,10 +58,10 @@ CKPT_SAVE_DIR = 'checkpoints'
 
 LEARNING_RATE = 4.5e-3 * BATCH_SIZE
 
-def load_models(rank=0, lr=1e-4, ckpt_path=None, vae_ckpt_path=None):
+def load_models(rank=0, lr=1e-4, ckpt_path=None, vae_ckpt_path=None, text_cache_dir=None, load_vae=True):
     ddpm = UNet()
-    vae = VAE().eval()
-    text_embedder = FrozenCLIPEmbedder(device=rank)
+    vae = VAE().eval() if load_vae else None # load_vae=False: latent-only training, the VAE is neither built nor loaded
+    text_embedder = FrozenCLIPEmbedder(device=rank, cache_dir=text_cache_dir)
     noise_schedule = NoiseSchedule()
     sampler = DDIMSampler(ddpm, noise_schedule=noise_schedule, tau_dim=50)
     opt = Adam(ddpm.parameters(), lr, (0.5, 0.9))
@@ -59,7 +69,7 @@ def load_models(rank=0, lr=1e-4, ckpt_path=None, vae_ckpt_path=None):
     resume_epoch_idx = 0
     resume_global_step_idx = 0
 
-    if vae_ckpt_path is not None:
+    if vae is not None and vae_ckpt_path is not None:
         if rank == 0:
             print(f'Loading VAE checkpoint from {vae_ckpt_path}')
         vae_ckpt = torch.load(vae_ckpt_path)
@@ -70,7 +80,7 @@ def load_models(rank=0, lr=1e-4, ckpt_path=None, vae_ckpt_path=None):
             print(f'Loading checkpoint from {ckpt_path}')
         ckpt = torch.load(ckpt_path)
         ddpm.load_state_dict(ckpt['ddpm_state_dict'])
-        opt.load_state_dict(ckpt['opt_state_dict'])
+        opt.load_state_dict(pack_optimizer_state(ddpm, ckpt['opt_state_dict'])) # checkpoints from before the fused MHA projections are repacked
         scaler.load_state_dict(ckpt['scaler_state_dict'])
         resume_epoch_idx = ckpt['epoch_idx']
         resume_global_step_idx = ckpt['global_step_idx']
@@ -94,7 +104,7 @@ class DDPMTrainer:
     ):
         self.rank = rank
         self.ddpm = DDP(ddpm.to(rank), device_ids=[rank])
-        self.vae = vae.to(rank)
+        self.vae = None if vae is None else vae.to(rank)
         self.text_embedder = text_embedder.to(rank)
         self.noise_schedule = noise_schedule.to(rank)
         self.sampler = sampler
@@ -106,7 +116,13 @@ class DDPMTrainer:
         self.scaler = scaler
         self.ckpt_save_dir = ckpt_save_dir
         self.wandb_run = wandb_run
-        self.z_std = None
+        self.use_latents = isinstance(dataset, LatentTextDataset)
+        self.pretokenized = isinstance(dataloader.collate_fn, TokenizingCollate) # batches hold input_ids instead of caption strings
+        self.z_std = dataset.z_std if self.use_latents else None
+
+        if self.use_latents:
+            self.z_shape = (dataset.nz, *dataset.latent_shape[1:])
+            return
 
         vae_downscale_factor = np.prod(self.vae.ch_mults)
         if isinstance(img_size, int):
@@ -130,6 +146,8 @@ class DDPMTrainer:
 
     def display_predictions(self, n_rows=1, n_cols=1,
             captions=None, display=True, save_path=None):
+        if self.vae is None: # training from a latent store without the VAE, nothing to decode the samples with
+            return
         n_imgs = n_rows * n_cols
         if captions is None:
             # get random captions from the training dataset
@@ -196,7 +214,7 @@ class DDPMTrainer:
         for epoch_idx in range(resume_epoch_idx, epochs):
             gc.collect()
 
-            self.dataloader.sampler.set_epoch(epoch_idx)
+            set_epoch(self.dataloader, epoch_idx)
             pbar = enumerate(self.dataloader)
             if self.rank == 0:
                 pbar = tqdm(pbar, total=steps_per_epoch, position=0)
@@ -205,19 +223,26 @@ class DDPMTrainer:
                 if step_idx == steps_per_epoch:
                     break
 
-                imgs = imgs.to(self.rank).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+                if self.use_latents: # imgs are the precomputed VAE encoder outputs
+                    z_params = imgs.to(self.rank, non_blocking=True)
+                else:
+                    imgs = imgs.to(self.rank, non_blocking=True).float() / 127.5 - 1.0
 
                 self.opt.zero_grad(set_to_none=True)
                 with torch.autocast('cuda', enabled=self.use_mixed):
-                    z_params = self.vae.encoder(imgs)
+                    if not self.use_latents:
+                        z_params = self.vae.encoder(imgs)
 
-                    mean, _log_var = torch.split(z_params, self.vae.nz, dim=1)
+                    mean, _log_var = torch.split(z_params, self.z_shape[0], dim=1)
                     if self.z_std is None:
                         self.z_std = mean.std()
                     mean = mean / self.z_std
 
                     noised, timesteps, noise = self.noise_schedule(mean)
-                    text_embeddings = self.text_embedder(captions)
+                    if self.pretokenized:
+                        text_embeddings = self.text_embedder.encode_tokens(captions)
+                    else:
+                        text_embeddings = self.text_embedder(captions)
 
                     noise_preds = self.ddpm(noised, timesteps, text_embeddings)
                     loss = F.mse_loss(noise_preds, noise)
@@ -258,23 +283,41 @@ def train(
     crop_size: int, batch_size: int, use_mixed: bool,
     learning_rate: float, img_folder_path: str, caption_file: str,
     ckpt_save_dir: str, ckpt_path: str = None,
-    vae_ckpt_path: str = None
+    vae_ckpt_path: str = None, latent_dir: str = None,
+    use_vae_decoder: bool = True, text_cache_dir: str = None,
+    packed_dir: str = None, streaming: bool = False,
+    manifest_dir: str = None, tokenize_in_workers: bool = True,
+    bucket_base_size: int = None
 ):
     ddp_setup(rank, world_size)
     load_model_return_vals = load_models(
             rank=rank, lr=learning_rate,
-            ckpt_path=ckpt_path, vae_ckpt_path=vae_ckpt_path)
+            ckpt_path=ckpt_path, vae_ckpt_path=vae_ckpt_path,
+            text_cache_dir=text_cache_dir, load_vae=latent_dir is None or use_vae_decoder)
     ddpm, vae, text_embedder = load_model_return_vals[0:3]
     noise_schedule, sampler = load_model_return_vals[3:5]
     opt, scaler = load_model_return_vals[5:7]
     resume_epoch_idx, resume_global_step_idx = load_model_return_vals[7:9]
 
     # persistent_workers - see https://discuss.pytorch.org/t/enumerate-dataloader-slow/87778/7
-    dataset = ImgTextDataset(img_folder_path, caption_file, crop_size)
+    if latent_dir is not None:
+        dataset = LatentTextDataset(latent_dir)
+    elif packed_dir is not None:
+        dataset_cls = StreamingImgTextDataset if streaming else PackedImgTextDataset
+        dataset = dataset_cls(packed_dir, crop_size)
+    else:
+        buckets = None if bucket_base_size is None else make_buckets(bucket_base_size)
+        dataset = ImgTextDataset(img_folder_path, caption_file, crop_size, manifest_dir=manifest_dir, buckets=buckets)
     num_dataloader_workers = cpu_count() // torch.cuda.device_count()
-    dataloader = DataLoader(dataset, batch_size // world_size, shuffle=False,
+    if getattr(dataset, 'buckets', None) is not None: # every batch comes from a single aspect ratio bucket
+        batching = dict(batch_sampler=AspectRatioBucketSampler(dataset.bucket_idxs, batch_size // world_size))
+    else:
+        data_sampler = None if isinstance(dataset, StreamingImgTextDataset) else DistributedSampler(dataset) # streaming datasets split shards over ranks themselves
+        batching = dict(batch_size=batch_size // world_size, shuffle=False, sampler=data_sampler)
+    dataloader = DataLoader(dataset,
             pin_memory=True, num_workers=num_dataloader_workers,
-            persistent_workers=num_dataloader_workers, sampler=DistributedSampler(dataset))
+            persistent_workers=num_dataloader_workers, **batching,
+            collate_fn=TokenizingCollate(text_embedder.version, text_embedder.max_length) if tokenize_in_workers else None)
 
     wandb_run = None
     if rank == 0 and USE_WANDB:
@@ -327,7 +370,11 @@ if __name__ == '__main__':
         CROP_SIZE, BATCH_SIZE, USE_MIXED,
         LEARNING_RATE, IMG_FOLDER_PATH, CAPTION_FILE,
         CKPT_SAVE_DIR, CKPT_PATH,
-        VAE_CKPT_PATH
+        VAE_CKPT_PATH, LATENT_DIR,
+        USE_VAE_DECODER, TEXT_CACHE_DIR,
+        PACKED_DIR, STREAMING,
+        MANIFEST_DIR, TOKENIZE_IN_WORKERS,
+        BUCKET_BASE_SIZE
     )
 
     mp.spawn(train, args=train_args, nprocs=world_size)
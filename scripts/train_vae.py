@@ -3,8 +3,10 @@ sys.path.append('.') # for python ./scripts/file.py
 sys.path.append('..') # for python file.py within ./scripts dir
 
 from modules.losses import kl_divergence, adv_loss_fn, PercepLoss
+from modules.layers import pack_optimizer_state
 from modules.models import VAE, Discriminator
-from modules.data import ImgTextDataset
+from modules.data import ImgTextDataset, PackedImgTextDataset, StreamingImgTextDataset
+from modules.data import AspectRatioBucketSampler, make_buckets, set_epoch
 from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data.distributed import DistributedSampler
@@ -34,6 +36,10 @@ WANDB_RUN_PATH = WANDB_MODEL_FNAME = None
 #WANDB_RUN_PATH = 'tiewa_enguin/ldm_vae/17jvvczf'
 IMG_FOLDER_PATH = 'dataset/imgs'
 CAPTION_FILE = 'dataset/id_to_text.txt'
+MANIFEST_DIR = None # manifest written by scripts/build_manifest.py, replaces globbing IMG_FOLDER_PATH at startup when set
+BUCKET_BASE_SIZE = None # train on aspect ratio buckets of about BUCKET_BASE_SIZE**2 pixels instead of CROP_SIZE squares (needs MANIFEST_DIR)
+PACKED_DIR = None # packed shards written by scripts/pack_dataset.py, used instead of IMG_FOLDER_PATH/CAPTION_FILE when set
+STREAMING = False # stream PACKED_DIR shards sequentially (per rank/worker) instead of random reads through a DistributedSampler
 
 CKPT_DIR = 'checkpoints'
 # save dirs may be different from load dirs if load dirs are unwritable (e.g. /kaggle/input)
@@ -57,7 +63,7 @@ def load_models(rank=0, lr=1e-4, ckpt_path=None):
         ckpt = torch.load(ckpt_path)
         vae.load_state_dict(ckpt['vae_state_dict'])
         disc.load_state_dict(ckpt['disc_state_dict'])
-        vae_opt.load_state_dict(ckpt['vae_opt_state_dict'])
+        vae_opt.load_state_dict(pack_optimizer_state(vae, ckpt['vae_opt_state_dict'])) # checkpoints from before the fused MHA projections are repacked
         disc_opt.load_state_dict(ckpt['disc_opt_state_dict'])
         scaler.load_state_dict(ckpt['scaler_state_dict'])
         resume_epoch_idx = ckpt['epoch_idx']
@@ -110,11 +116,14 @@ class AutoencoderTrainer:
         if model_input is None:
             # get random images from the training dataset
             img_idxs = np.random.randint(0, len(self.dataset), (n_imgs,))
+            bucket_idxs = getattr(self.dataset, 'bucket_idxs', None)
+            if bucket_idxs is not None: # images of different buckets have different shapes, take them all from the first image's bucket
+                img_idxs = np.random.choice(np.flatnonzero(bucket_idxs == bucket_idxs[img_idxs[0]]), n_imgs)
             imgs = []
             for idx in img_idxs:
                 img, _caption = self.dataset[idx]
                 imgs.append(img)
-            model_input = torch.tensor(np.array(imgs), dtype=torch.float32).permute(0, 3, 1, 2).to(self.rank) / 127.5 - 1.0
+            model_input = torch.stack(imgs).to(self.rank).float() / 127.5 - 1.0
 
         toggle = self.vae.training
         if toggle:
@@ -176,7 +185,7 @@ class AutoencoderTrainer:
         for epoch_idx in range(resume_epoch_idx, epochs):
             gc.collect()
 
-            self.dataloader.sampler.set_epoch(epoch_idx)
+            set_epoch(self.dataloader, epoch_idx)
             pbar = enumerate(self.dataloader)
             if self.rank == 0:
                 pbar = tqdm(pbar, total=steps_per_epoch, position=0)
@@ -185,7 +194,7 @@ class AutoencoderTrainer:
                 if step_idx == steps_per_epoch:
                     break
 
-                imgs = imgs.to(self.rank).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+                imgs = imgs.to(self.rank).float() / 127.5 - 1.0
 
                 # G update
                 self.vae_opt.zero_grad(set_to_none=True)
@@ -294,6 +303,8 @@ def train(
     learning_rate: float, adv_step_threshold: int,
     img_folder_path: str, caption_file: str,
     ckpt_save_dir: str, ckpt_path: str = None,
+    packed_dir: str = None, streaming: bool = False,
+    manifest_dir: str = None, bucket_base_size: int = None
 ):
     ddp_setup(rank, world_size)
     load_model_return_vals = load_models(rank=rank, lr=learning_rate, ckpt_path=ckpt_path)
@@ -302,11 +313,21 @@ def train(
     resume_epoch_idx, resume_global_step_idx = load_model_return_vals[6:8]
 
     # persistent_workers - see https://discuss.pytorch.org/t/enumerate-dataloader-slow/87778/7
-    dataset = ImgTextDataset(img_folder_path, caption_file, crop_size)
+    if packed_dir is not None:
+        dataset_cls = StreamingImgTextDataset if streaming else PackedImgTextDataset
+        dataset = dataset_cls(packed_dir, crop_size)
+    else:
+        buckets = None if bucket_base_size is None else make_buckets(bucket_base_size)
+        dataset = ImgTextDataset(img_folder_path, caption_file, crop_size, manifest_dir=manifest_dir, buckets=buckets)
     num_dataloader_workers = cpu_count() // torch.cuda.device_count()
-    dataloader = DataLoader(dataset, batch_size // world_size, shuffle=False,
+    if getattr(dataset, 'buckets', None) is not None: # every batch comes from a single aspect ratio bucket
+        batching = dict(batch_sampler=AspectRatioBucketSampler(dataset.bucket_idxs, batch_size // world_size))
+    else:
+        data_sampler = None if isinstance(dataset, StreamingImgTextDataset) else DistributedSampler(dataset) # streaming datasets split shards over ranks themselves
+        batching = dict(batch_size=batch_size // world_size, shuffle=False, sampler=data_sampler)
+    dataloader = DataLoader(dataset,
             pin_memory=True, num_workers=num_dataloader_workers,
-            persistent_workers=num_dataloader_workers, sampler=DistributedSampler(dataset))
+            persistent_workers=num_dataloader_workers, **batching)
 
     wandb_run = None
     if rank == 0 and USE_WANDB:
@@ -344,10 +365,12 @@ if __name__ == '__main__':
     train_args = (
         world_size,
         EPOCHS, STEPS_PER_EPOCH,
-        CROP_SIZE, BATCH_SIZE, USE_MIXED
+        CROP_SIZE, BATCH_SIZE, USE_MIXED,
         LEARNING_RATE, ADV_STEP_THRESHOLD,
         IMG_FOLDER_PATH, CAPTION_FILE,
-        CKPT_SAVE_DIR, CKPT_PATH
+        CKPT_SAVE_DIR, CKPT_PATH,
+        PACKED_DIR, STREAMING,
+        MANIFEST_DIR, BUCKET_BASE_SIZE
     )
 
     mp.spawn(train, args=train_args, nprocs=world_size)